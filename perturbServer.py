@@ -0,0 +1,299 @@
+'''
+    Description: Online perturbation service. Wraps a frozen surrogate M5 (saved by speechClass.py) and the min-min
+                 attack so newly uploaded clips can be protected at ingest time. Concurrent requests are grouped into
+                 dynamic batches (max batch size / max latency), segment epsilons are computed on the fly.
+                 Modes: "serve" runs a local HTTP (or Unix-socket) server, "bench" runs a load generator against it
+                 and reports p50/p99 latency and clips/s.
+    Requires: experiments/surrogate.pt (from speechClass.py)
+    Usage: python perturbServer.py [serve|bench]
+           POST /perturb with raw little-endian float32 samples (16 kHz, at most 1 second) as body,
+           optional "X-Label" header with the label name. Response body is the perturbed clip in the same format.
+    Date: 10/19/2026
+'''
+import torch
+import torch.nn as nn
+import numpy as np
+import os
+import sys
+import time
+import queue
+import socket
+import threading
+import socketserver
+import http.client
+import concurrent.futures
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from surrogate_tools import load_surrogate, compute_segment_values, BatchedMinMinAttack
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+####################################
+##   VARIABLES: CHANGE AS NEEDED  ##
+####################################
+mode = "serve"                  # "serve" or "bench" (can also be passed as first argument)
+surrogate_path = "experiments/surrogate.pt"
+host = "127.0.0.1"
+port = 8765
+socket_path = None              # set to a path (e.g. "/tmp/perturb.sock") to serve on a Unix socket instead
+max_batch_size = 64             # largest dynamic batch
+max_latency_ms = 20             # longest a request waits for its batch to fill
+inference_jit = False           # trace + freeze the BatchNorm-folded surrogate (oneDNN conv+ReLU fusion)
+# Noise Variables (MATCH speechClass.py)
+eps_max_value = 0.13
+step_size_factor = 25
+segment_size = 1000
+train_step = 20
+SR = 16000
+# Benchmark Variables
+bench_clients = 32
+bench_requests = 512
+
+if len(sys.argv) > 1:
+    mode = sys.argv[1]
+
+
+
+
+#######################################################################################################
+### DYNAMIC BATCHING SERVICE ###
+#######################################################################################################
+class PerturbationService:
+    '''In-process API: submit() single waveforms from any thread, a worker thread groups them into batches of up
+    to max_batch_size, waiting at most max_latency_ms after the first request of a batch.'''
+    def __init__(self, model, label_types, max_batch_size=64, max_latency_ms=20):
+        self.model = model
+        self.label_types = label_types
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.
+        self.attack = BatchedMinMinAttack(train_step)
+        self.criterion = nn.CrossEntropyLoss()
+        self.requests = queue.Queue()
+        self.num_batches = 0
+        self.num_clips = 0
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def validate(self, waveform, label=None):
+        # Request checks, raised as ValueError before anything is queued
+        if waveform.shape[0] > SR:
+            raise ValueError(f'Clip has {waveform.shape[0]} samples, at most {SR} are supported')
+        if label is not None and label not in self.label_types:
+            raise ValueError(f'Unknown label {label}')
+
+    def submit(self, waveform, label=None):
+        # waveform: 1D float tensor/array at SR, at most SR samples. Returns a Future of the perturbed waveform
+        future = concurrent.futures.Future()
+        waveform = torch.as_tensor(waveform, dtype=torch.float32).flatten()
+        self.validate(waveform, label)
+        self.requests.put((time.monotonic(), waveform, label, future))
+        return future
+
+    def perturb(self, waveform, label=None, timeout=None):
+        return self.submit(waveform, label).result(timeout)
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def _run(self):
+        while True:
+            first = self.requests.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = first[0] + self.max_latency
+            stop = False
+            # Keep filling the batch until it is full or the first request's deadline passes
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._process(batch)
+            if stop:
+                return
+
+    def _process(self, batch):
+        futures = [future for *_, future in batch]
+        try:
+            lengths = [waveform.shape[0] for _, waveform, _, _ in batch]
+            data = torch.zeros(len(batch), 1, SR)
+            for b, (_, waveform, _, _) in enumerate(batch):
+                data[b, 0, :lengths[b]] = waveform
+            data = data.to(device)
+            precomputed_values = compute_segment_values(data, segment_size, eps_max_value, step_size_factor)
+
+            # Unlabeled clips are pushed towards the surrogate's own prediction
+            with torch.no_grad():
+                predicted = self.model(data).squeeze(1).argmax(dim=-1)
+            labels = torch.tensor([predicted[b].item() if label is None else self.label_types.index(label)
+                                   for b, (_, _, label, _) in enumerate(batch)], device=device)
+
+            perturb_audio, _ = self.attack.attack(data, labels, self.model, self.criterion, precomputed_values,
+                                                  init_noise=torch.zeros_like(data))
+            perturb_audio = perturb_audio.cpu()
+            self.num_batches += 1
+            self.num_clips += len(batch)
+            for b, future in enumerate(futures):
+                future.set_result(perturb_audio[b, 0, :lengths[b]])
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+
+
+
+#######################################################################################################
+### HTTP / UNIX-SOCKET SERVER ###
+#######################################################################################################
+class PerturbHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_POST(self):
+        if self.path != '/perturb':
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        label = self.headers.get('X-Label')
+        # Bad requests (400) are rejected here, anything raised by the batch worker is a server error (500)
+        try:
+            waveform = torch.from_numpy(np.frombuffer(body, dtype='<f4').copy())
+            self.service.validate(waveform, label)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        try:
+            perturbed = self.service.perturb(waveform, label=label)
+        except Exception as e:
+            # Failure inside the batch (e.g. the model), reported instead of dropping the connection
+            self.send_error(500, f'{type(e).__name__}: {e}')
+            return
+        payload = perturbed.numpy().astype('<f4').tobytes()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+
+def make_server(service, bind_port):
+    PerturbHandler.service = service
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # stale socket from an earlier run
+        return UnixHTTPServer(socket_path, PerturbHandler)
+    return ThreadingHTTPServer((host, bind_port), PerturbHandler)
+
+
+def make_connection(server):
+    if socket_path is not None:
+        return UnixHTTPConnection(socket_path)
+    return http.client.HTTPConnection(host, server.server_address[1])
+
+
+
+
+#######################################################################################################
+### LOAD GENERATOR ###
+#######################################################################################################
+def run_benchmark(server, service):
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    requests_per_client = bench_requests // bench_clients
+
+    def client(client_id):
+        rng = np.random.RandomState(client_id)
+        connection = make_connection(server)
+        for _ in range(requests_per_client):
+            # Speech-like test clip: noise with a louder burst in the middle
+            waveform = (rng.randn(SR) * 0.02).astype('<f4')
+            waveform[SR // 4:3 * SR // 4] *= 10
+            waveform = np.clip(waveform, -1, 1)
+            start = time.perf_counter()
+            try:
+                connection.request('POST', '/perturb', body=waveform.tobytes())
+                response = connection.getresponse()
+                response.read()
+                error = None if response.status == 200 else f'status {response.status} {response.reason}'
+            except (OSError, http.client.HTTPException) as e:
+                error = f'{type(e).__name__}: {e}'
+                connection.close()
+                connection = make_connection(server)
+            elapsed = time.perf_counter() - start
+            # Failed requests are counted, not timed
+            with lock:
+                if error is None:
+                    latencies.append(elapsed)
+                else:
+                    failures.append(error)
+        connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(bench_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_time = time.perf_counter() - start
+
+    if failures:
+        print(f"WARNING: {len(failures)}/{len(failures) + len(latencies)} requests failed, first: {failures[0]}", flush=True)
+    if not latencies:
+        raise RuntimeError('Every benchmark request failed')
+    latencies_ms = np.array(latencies) * 1000
+    print(f"Clients: {bench_clients}   Requests: {len(latencies)} ok, {len(failures)} failed   Max batch: {max_batch_size}   Max latency: {max_latency_ms}ms")
+    print(f"p50 latency: {np.percentile(latencies_ms, 50):.1f}ms   p99 latency: {np.percentile(latencies_ms, 99):.1f}ms")
+    print(f"Throughput: {len(latencies) / total_time:.1f} clips/s   Avg batch size: {service.num_clips / max(service.num_batches, 1):.1f}", flush=True)
+
+
+
+
+model, label_types = load_surrogate(surrogate_path, device, use_jit=inference_jit, SR=SR)
+service = PerturbationService(model, label_types, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms)
+
+if mode == "serve":
+    server = make_server(service, port)
+    print(f"Serving perturbations on {socket_path or '%s:%d' % (host, port)}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.close()
+elif mode == "bench":
+    server = make_server(service, 0)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    run_benchmark(server, service)
+    server.shutdown()
+    server.server_close()
+    service.close()
+else:
+    raise ValueError('Invalid mode')
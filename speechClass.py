@@ -14,14 +14,21 @@ import torchaudio
 import sys
 import logging
 import random
+import hashlib
+import inspect
+import wave
 
 import matplotlib.pyplot as plt
 import IPython.display as ipd
 
 import numpy as np
+import copy
 from tqdm import tqdm
 from torch.autograd import Variable
+from torch.func import stack_module_state, functional_call, vmap
 from torch.utils.data import SubsetRandomSampler
+from surrogate_tools import M5, fold_batchnorm, export_inference_m5, placement_table, piecewise_eps_func, compute_segment_values
+from surrogate_tools import EPS_TIERS, eps_tier_edges, RunningStats, noise_stats, update_noise_stats
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(device)
@@ -34,6 +41,8 @@ import os
 ####################################
 # Generating Noise Variables
 batch_size = 256                # batch size as 256
+shuffle_batches = True          # noise is looked up by sample id, so the loader may shuffle
+loader_workers = 0              # DataLoader worker processes (0 = load in the main process)
 target_error_rate = 0.08         # loss threshold (CURRENTLY USING)
 #target_accuracy_rate = 90.0     # accuracy threshold
 
@@ -44,11 +53,25 @@ eps_max_value = 0.13
 eps_cutoff = [0, 0.01, 0.025, 0.05, 0.1, 0.3]   # old implementation 
 step_size_factor = 25       # distance of each step (in min-min attack)
 segment_size = 1000         # size of each segment 
+patch_location = 'center'   # where each sample's noise is placed ('center' or 'random', seeded by seed)
 train_step = 20             # number of train steps the model will do in each epoch (during Min-Min attack) increase to raise unlearnability
+ensemble_size = 1           # number of M5 surrogates the noise is optimized against (1 = single surrogate)
+adaptive_steps = False      # stop the min-min attack early once loss and noise have both stopped changing
+adaptive_loss_tol = 1e-3    # ... loss change between two steps below this
+adaptive_change_tol = 0.01  # ... and fraction of noise coordinates still changing below this
+momentum_decay = 0.0        # > 0: sign steps follow a gradient momentum, carried over between outer iterations
+inference_jit = False       # trace + freeze the BatchNorm-folded surrogate used by the attack (oneDNN conv+ReLU fusion)
+resolution_schedule = []    # coarse-to-fine: [(factor, outer iterations), ...] e.g. [(8, 2), (4, 2)], then full resolution
 # Audio Sample Varaibles
 seed = 8 #8
+poison_rate = 1.0           # fraction of training samples to generate noise for (MATCH poison_rate in trainPerturb.py)
+target_idx_path = None      # optional file with an explicit list of training indices to generate noise for
+incremental = False         # update the saved perturbation store for new/changed clips instead of regenerating it
+refresh_fraction = 0.1      # share of the existing (unchanged) samples re-attacked alongside the new ones
 transform_sample_rate = 8000
 ex_name = "experiments"     # folder name to save model to
+use_cache = True            # reuse epsilon tables/noise placements from earlier runs with the same inputs
+cache_dir = os.path.join(ex_name, "cache")
 # Testing/debugging Variables
 SR = 16000
 EXAMPLES = 3
@@ -79,18 +102,50 @@ class SubsetSC(SPEECHCOMMANDS):
             random.seed(seed)
             random.shuffle(self._walker)
 
+    def __getitem__(self, n):
+        # Append the sample id (position in this subset) so noise rows stay aligned under shuffling/workers
+        return (*super().__getitem__(n), n)
+
 
 # Create training and testing split of the data.
 train_set = SubsetSC("training")
 test_set = SubsetSC("testing")
 
+# Contains names of all sound labels (label is the clip's folder name, taken before subsetting)
+label_types = sorted(list(set(os.path.basename(os.path.dirname(path)) for path in train_set._walker)))
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+# Only generate noise for the poison targets: row r of the noise belongs to training sample target_idx[r]
+manifest_path = os.path.join(ex_name, 'perturbation_manifest.pt')
+if incremental:
+    # Keep the clips that already have noise, and pick targets among the clips added since the last run
+    old_manifest = torch.load(manifest_path)
+    old_training_paths = set(old_manifest['training_paths'])
+    old_row_paths = set(old_manifest['paths'])
+    kept = [i for i, path in enumerate(train_set._walker) if path in old_row_paths]
+    added = [i for i, path in enumerate(train_set._walker) if path not in old_training_paths]
+    added_targets = np.random.RandomState(seed).choice(added, int(len(added) * poison_rate), replace=False).tolist() if added else []
+    target_idx = sorted(kept + added_targets)
+    print(f"Incremental: {len(kept)} clips with existing noise, {len(added)} new clips ({len(added_targets)} targets)", flush=True)
+elif target_idx_path is not None:
+    target_idx = sorted(set(int(i) for i in torch.load(target_idx_path)))
+else:
+    target_idx = sorted(np.random.RandomState(seed).choice(len(train_set), int(len(train_set) * poison_rate), replace=False).tolist())
+training_paths = list(train_set._walker)
+print(f"Generating noise for {len(target_idx)}/{len(train_set)} training samples", flush=True)
+train_set._walker = [train_set._walker[i] for i in target_idx]
+
 
 #Shuffle indices
 train_sampler = SubsetRandomSampler(torch.randperm(len(train_set)))
 
 
 # Testing first dataset sample
-waveform, sample_rate, label, speaker_id, utterance_number = train_set[0]
+waveform, sample_rate, label, speaker_id, utterance_number, _ = train_set[0]
 print ("==Test [0]==", flush=True)
 print(f"Testset[0]: {train_set[0]}")
 print(f" Waveform {waveform} \n Sample Rate: {sample_rate} \n Label: {label} \n Utterance Num: {utterance_number}", flush=True)
@@ -98,9 +153,6 @@ print("Shape of waveform: {}".format(waveform.size()))
 print("Sample rate of waveform: {}".format(sample_rate))
 
 
-# Contains names of all sound labels
-label_types = sorted(list(set(datapoint[2] for datapoint in train_set)))
-
 # TRANSFORMATIONS (currently none applied)
 transform = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=sample_rate) #transform_sample_rate)
 transformed = transform(waveform)
@@ -133,32 +185,35 @@ def pad_sequence(batch):
 
 
 def collate_fn(batch):
-    tensors, targets = [], []
+    tensors, targets, ids = [], [], []
 
-    # Gather in lists, and encode labels as indices
-    for waveform, _, label, *_ in batch:
+    # Gather in lists, and encode labels as indices (sample id is the last item)
+    for waveform, _, label, *_, sample_id in batch:
         tensors += [waveform]
         targets += [label_to_index(label)]
+        ids += [sample_id]
         
-    # Group the list of tensors into a batched tensor
+    # Group the list of tensors into a batched tensor, always SR long so every batch has the same segments
     tensors = pad_sequence(tensors)
+    if tensors.shape[2] < SR:
+        tensors = F.pad(tensors, (0, SR - tensors.shape[2]))
     targets = torch.stack(targets)
 
  
-    return tensors, targets
+    return tensors, targets, torch.tensor(ids)
 
 
 if device == "cuda":
-    num_workers = 1
+    num_workers = max(1, loader_workers)
     pin_memory = True
 else:
-    num_workers = 0
+    num_workers = loader_workers
     pin_memory = False
 
 train_loader = torch.utils.data.DataLoader(
     train_set,
     batch_size=batch_size,
-    shuffle=False,      #CHANGED TO FALSE!!!
+    shuffle=shuffle_batches,
     collate_fn=collate_fn,
     num_workers=num_workers,
     pin_memory=pin_memory,
@@ -172,45 +227,38 @@ train_loader = torch.utils.data.DataLoader(
 
 
 #####################################################################################################
-## DEFINE the Network (CNN)
+## DEFINE the Network (CNN, M5 is in surrogate_tools.py)
 #####################################################################################################
-class M5(nn.Module):        # 13 and 32 -> 35 and 17
-    def __init__(self, n_input=1, n_output=35, stride=16, n_channel=32):
+class SurrogateEnsemble(nn.Module):
+    '''K independently initialized M5 surrogates. Members are trained one by one, but for the attack their
+    BatchNorm-folded parameters are stacked and evaluated in one vmapped call, returning the mean log-probabilities.'''
+    def __init__(self, members):
         super().__init__()
-        self.conv1 = nn.Conv1d(n_input, n_channel, kernel_size=80, stride=stride)
-        self.bn1 = nn.BatchNorm1d(n_channel)
-        self.pool1 = nn.MaxPool1d(4)
-        self.conv2 = nn.Conv1d(n_channel, n_channel, kernel_size=3)
-        self.bn2 = nn.BatchNorm1d(n_channel)
-        self.pool2 = nn.MaxPool1d(4)
-        self.conv3 = nn.Conv1d(n_channel, 2 * n_channel, kernel_size=3)
-        self.bn3 = nn.BatchNorm1d(2 * n_channel)
-        self.pool3 = nn.MaxPool1d(4)
-        self.conv4 = nn.Conv1d(2 * n_channel, 2 * n_channel, kernel_size=3)
-        self.bn4 = nn.BatchNorm1d(2 * n_channel)
-        self.pool4 = nn.MaxPool1d(4)
-        self.fc1 = nn.Linear(2 * n_channel, n_output)
+        self.members = nn.ModuleList(members)
+        self.restack()
+
+    def restack(self):
+        # Snapshot the current (folded) member weights as stacked (K, ...) tensors, no grad to the parameters
+        folded = [fold_batchnorm(member) for member in self.members]
+        params, buffers = stack_module_state(folded)
+        self.stacked_params = {name: p.detach() for name, p in params.items()}
+        self.stacked_buffers = {name: b.detach() for name, b in buffers.items()}
+        base = copy.deepcopy(folded[0]).to("meta")
+
+        def member_forward(params, buffers, x):
+            return functional_call(base, (params, buffers), (x,))
+        self.vmapped_forward = vmap(member_forward, in_dims=(0, 0, None))
 
     def forward(self, x):
-        x = self.conv1(x)
-        x = F.relu(self.bn1(x))
-        x = self.pool1(x)
-        x = self.conv2(x)
-        x = F.relu(self.bn2(x))
-        x = self.pool2(x)
-        x = self.conv3(x)
-        x = F.relu(self.bn3(x))
-        x = self.pool3(x)
-        x = self.conv4(x)
-        x = F.relu(self.bn4(x))
-        x = self.pool4(x)
-        x = F.avg_pool1d(x, x.shape[-1])
-        x = x.permute(0, 2, 1)
-        x = self.fc1(x)
-        return F.log_softmax(x, dim=2)
+        # One fused forward over all K members: (K, batch, 1, n_output) -> mean over members
+        return self.vmapped_forward(self.stacked_params, self.stacked_buffers, x).mean(dim=0)
+
 
 # Set model, send to GPU, and print
-model = M5(n_input=transformed.shape[0], n_output=len(label_types))
+if ensemble_size > 1:
+    model = SurrogateEnsemble([M5(n_input=transformed.shape[0], n_output=len(label_types)).to(device) for _ in range(ensemble_size)])
+else:
+    model = M5(n_input=transformed.shape[0], n_output=len(label_types))
 model.to(device)
 print(model)
 
@@ -223,6 +271,52 @@ criterion = nn.CrossEntropyLoss()
 noise_shape = [len(train_set), 16000]
 random_noise = torch.zeros(noise_shape) #init with all zeroes
 
+# Incremental: existing rows start from the saved noise and the surrogate from its checkpoint,
+# the min-min search then runs over the new/changed clips plus a random refresh of the others
+attack_set = train_set
+if incremental:
+    old_noise = torch.load(os.path.join(ex_name, 'perturbation.pt'), map_location='cpu')
+    old_rows = {(path, tuple(fingerprint)): row for row, (path, fingerprint) in enumerate(zip(old_manifest['paths'], old_manifest['fingerprints']))}
+    new_ids, existing_ids = [], []
+    for sample_id, path in enumerate(train_set._walker):
+        row = old_rows.get((path, file_fingerprint(path)))
+        if row is None:
+            new_ids.append(sample_id)
+        else:
+            random_noise[sample_id] = old_noise[row]
+            existing_ids.append(sample_id)
+    # Refresh a different window of a seeded order on every run, so repeated runs cycle through all existing rows
+    refresh_round = old_manifest.get('refresh_round', 0)
+    num_refresh = int(len(existing_ids) * refresh_fraction)
+    refresh_order = np.random.RandomState(seed).permutation(existing_ids) if existing_ids else np.zeros(0, dtype=np.int64)
+    refresh_ids = refresh_order[(refresh_round * num_refresh + np.arange(num_refresh)) % max(len(existing_ids), 1)].tolist()
+    print(f"Incremental: attacking {len(new_ids)} new/changed + {len(refresh_ids)} refreshed samples", flush=True)
+    attack_set = torch.utils.data.Subset(train_set, sorted(new_ids + refresh_ids))
+
+    checkpoint = torch.load(os.path.join(ex_name, 'surrogate.pt'), map_location=device)
+    # The restored surrogate's class indices must mean the same labels as now
+    if checkpoint['labels'] != label_types:
+        added = sorted(set(label_types) - set(checkpoint['labels']))
+        removed = sorted(set(checkpoint['labels']) - set(label_types))
+        raise ValueError(f"Label set changed since the saved surrogate (added: {added}, removed: {removed}, "
+                         f"or reordered); run a full generation with incremental = False")
+    surrogates = model.members if ensemble_size > 1 else [model]
+    if len(checkpoint['state_dicts']) != len(surrogates):
+        raise ValueError(f"Saved surrogate has {len(checkpoint['state_dicts'])} model(s) but ensemble_size is {ensemble_size}")
+    for member, state_dict in zip(surrogates, checkpoint['state_dicts']):
+        member.load_state_dict(state_dict)
+
+attack_loader = torch.utils.data.DataLoader(
+    attack_set,
+    batch_size=batch_size,
+    shuffle=shuffle_batches,
+    collate_fn=collate_fn,
+    num_workers=num_workers,
+    pin_memory=pin_memory,
+)
+if momentum_decay > 0:
+    grad_momentum_store = torch.zeros(noise_shape[0], 1, noise_shape[1])   # per-sample momentum between outer iterations
+
 
 
 
@@ -240,50 +334,51 @@ random_noise = torch.zeros(noise_shape) #init with all zeroes
 #######################################################################################################
 ### ADD PERTURBATION/NOISE ###
 #######################################################################################################
-def perturb_eval(random_noise, train_loader, model, startAndEnd_list, mask_cord_list):
+def perturb_eval(random_noise, train_loader, model, placements):
     print("In Perturb Eval", flush=True)
     loss_meter = AverageMeter()
     err_meter = AverageMeter()
    # model.eval()
     model = model.to(device)
-    idx_v = 0
-    # Iterate over Data Loader (batches of audio and labels)
-    for i, (data, labels) in enumerate(train_loader):
+    stats = noise_stats(eps_max_value)
+    # Iterate over Data Loader (batches of audio, labels and sample ids)
+    for i, (data, labels, ids) in enumerate(train_loader):
         data, labels = data.to(device,non_blocking=True), labels.to(device, non_blocking=True)
        
         if random_noise is not None:
-            for i, (datum, label) in enumerate(zip(data, labels)):
-                if not torch.is_tensor(random_noise):
-                    sample_noise = torch.tensor(random_noise[idx_v]).to(device)
-                else:
-                    sample_noise = random_noise[idx_v].to(device)
-            
-                length = datum.shape[1] 
-                mask = np.zeros(length, np.float32)
-                start,end = startAndEnd_list[idx_v]
-                mask[start:end] = sample_noise.cpu().numpy()
-                sample_noise = torch.from_numpy(mask).to(device)
-                data[i] = data[i] + sample_noise
-                idx_v += 1
+            clean = data
+            data = apply_noise_patches(data, random_noise[ids], placements[ids])
+            update_noise_stats(stats, clean, data - clean)
         # squeeze to get rid of 2nd dimension
         pred = model(data).squeeze(1)
         err = (pred.data.max(1)[1] != labels.data).float().sum()
         loss = torch.nn.CrossEntropyLoss()(pred, labels)
         loss_meter.update(loss.item(), len(labels))
         err_meter.update(err/len(labels))
+    for stat in stats:
+        print(stat.summary(), flush=True)
     return loss_meter.avg, err_meter.avg
                 
 
 class PerturbationTool:
-    def __init__(self, epsilon_cutoff, segment_size, step_size_factor, num_steps,seed=0):
+    def __init__(self, epsilon_cutoff, segment_size, step_size_factor, num_steps,seed=0, adaptive=False, loss_tol=1e-3, change_tol=0.01, momentum=0.0, resolution=1):
         self.epsilon_cutoff = epsilon_cutoff
         self.seg_size = segment_size
         self.step_size_fac = step_size_factor
         self.num_steps = num_steps
         self.seed = seed
+        self.adaptive = adaptive        # early exit once loss change < loss_tol and changing fraction < change_tol
+        self.loss_tol = loss_tol
+        self.change_tol = change_tol
+        self.momentum = momentum        # decay of the gradient momentum (0 = plain sign gradient)
+        self.steps_used = 0             # steps run by the last min_min_attack call
+        self.grad_momentum = None       # momentum after the last min_min_attack call (to warm-start the next one)
+        self.resolution = resolution    # > 1: optimize one noise value per `resolution` samples (coarse_min_min_attack)
         np.random.seed(seed)
 
-    def min_min_attack(self, audio_samples, labels, model, optimizer, criterion, i, random_noise=None, precomputed_values=None):
+    def min_min_attack(self, audio_samples, labels, model, optimizer, criterion, i, random_noise=None, precomputed_values=None, grad_momentum=None):
+        if self.resolution > 1:
+            return self.coarse_min_min_attack(audio_samples, labels, model, criterion, random_noise, precomputed_values, grad_momentum)
         init_epsilon = 0.01
         device = audio_samples.device
         current_batch_size, num_channels, audio_len = audio_samples.shape
@@ -324,6 +419,8 @@ class PerturbationTool:
 
 
         ## 2:  Go through num_steps times, Updating noise across ENTIRE wavelength ##
+        prev_loss = None
+        self.steps_used = 0
         for _ in range(self.num_steps):
             full_perturb_audio = []
         
@@ -353,11 +450,23 @@ class PerturbationTool:
                 logits, loss = criterion(model, full_perturb_audio, labels, optimizer)
             
             loss.backward(retain_graph=True) 
+            self.steps_used += 1
+
+            # Step direction: raw gradient, or momentum of the per-sample normalized gradient
+            step_grad = full_perturb_audio.grad
+            if self.momentum > 0:
+                if grad_momentum is None:
+                    grad_momentum = torch.zeros_like(step_grad)
+                grad_norm = step_grad.abs().mean(dim=(1, 2), keepdim=True).clamp_min(1e-12)
+                grad_momentum = self.momentum * grad_momentum + step_grad / grad_norm
+                step_grad = grad_momentum
+            if self.adaptive:
+                prev_eta = eta.clone()     # only needed for the early-exit check
 
             # Update Each segment based on loss of the combined segments
             for b in range(current_batch_size):
                 for j, (segment_perturb, segment_noise, epsilon, step_size, startSeg, endSeg) in enumerate(segment_noise_list[b]):
-                    grad_segment = full_perturb_audio.grad[b:b+1, :, startSeg:endSeg]
+                    grad_segment = step_grad[b:b+1, :, startSeg:endSeg]
                     if grad_segment is not None:
                         eta_segment = step_size * grad_segment.data.sign() * (-1)
                         segment_perturb = Variable(segment_perturb.data + eta_segment, requires_grad=True)
@@ -368,6 +477,13 @@ class PerturbationTool:
                         # Update the noise list and eta
                         segment_noise_list[b][j] = (segment_perturb, segment_noise, epsilon, step_size, startSeg, endSeg)
                         eta[b:b+1, :, startSeg:endSeg] = eta_segment
+
+            # Adaptive mode: stop once the loss has flattened and almost no coordinate moves anymore
+            if self.adaptive and prev_loss is not None:
+                changed_fraction = (eta != prev_eta).float().mean().item()
+                if abs(prev_loss - loss.item()) < self.loss_tol and changed_fraction < self.change_tol:
+                    break
+            prev_loss = loss.item()
                    
 
         # Update the overall perturbed audio and return
@@ -376,8 +492,71 @@ class PerturbationTool:
             for segment_perturb, _, _, _, start, end in segment_noise_list[b]:
                 new_perturb_audio[b:b+1, :, start:end] = segment_perturb.detach() #NEW
         
+        self.grad_momentum = grad_momentum
         return new_perturb_audio, eta
 
+    def coarse_min_min_attack(self, audio_samples, labels, model, criterion, random_noise=None, precomputed_values=None, grad_momentum=None):
+        # Same sign-gradient search on a low-resolution noise z, upsampled (nearest) before it is added to the audio
+        init_epsilon = 0.01
+        r = self.resolution
+        device = audio_samples.device
+        audio_len = audio_samples.shape[2]
+
+        # Per-sample epsilon/step size tensors from the segment table
+        eps = torch.zeros_like(audio_samples)
+        step = torch.zeros_like(audio_samples)
+        for b, sample_precomputed_values in enumerate(precomputed_values):
+            for epsilon, step_size, startSeg, endSeg, _ in sample_precomputed_values:
+                eps[b, :, startSeg:endSeg] = epsilon
+                step[b, :, startSeg:endSeg] = step_size
+        # Smallest epsilon inside each block, so the upsampled noise respects every segment's epsilon
+        coarse_eps = -F.max_pool1d(-eps, r, ceil_mode=True)
+        coarse_step = -F.max_pool1d(-step, r, ceil_mode=True)
+
+        def upsample(z):
+            return z.repeat_interleave(r, dim=2)[:, :, :audio_len]
+
+        # Start from the current noise (random_noise holds the noisy audio, as in min_min_attack)
+        if random_noise is None:
+            delta = torch.FloatTensor(*audio_samples.shape).uniform_(-init_epsilon, init_epsilon).to(device)
+        else:
+            delta = random_noise - audio_samples
+        z = torch.clamp(F.avg_pool1d(delta, r, ceil_mode=True), -coarse_eps, coarse_eps)
+        if grad_momentum is not None:
+            grad_momentum = F.avg_pool1d(grad_momentum, r, ceil_mode=True) * r
+
+        prev_loss = None
+        self.steps_used = 0
+        for _ in range(self.num_steps):
+            z = z.detach().requires_grad_(True)
+            model.zero_grad()
+            logits = model(torch.clamp(audio_samples + upsample(z), -1, 1)).squeeze(1)
+            loss = criterion(logits, labels)
+            grad, = torch.autograd.grad(loss, z)
+            self.steps_used += 1
+
+            if self.momentum > 0:
+                if grad_momentum is None:
+                    grad_momentum = torch.zeros_like(grad)
+                grad_norm = grad.abs().mean(dim=(1, 2), keepdim=True).clamp_min(1e-12)
+                grad_momentum = self.momentum * grad_momentum + grad / grad_norm
+                grad = grad_momentum
+            prev_z = z.detach()
+            z = torch.clamp(prev_z - coarse_step * grad.sign(), -coarse_eps, coarse_eps)
+
+            # Adaptive mode: stop once the loss has flattened and almost no coordinate moves anymore
+            if self.adaptive and prev_loss is not None:
+                changed_fraction = (z != prev_z).float().mean().item()
+                if abs(prev_loss - loss.item()) < self.loss_tol and changed_fraction < self.change_tol:
+                    break
+            prev_loss = loss.item()
+
+        if grad_momentum is not None:
+            grad_momentum = upsample(grad_momentum) / r
+        self.grad_momentum = grad_momentum
+        eta = upsample(z.detach())
+        return torch.clamp(audio_samples + eta, -1, 1), eta
+
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -400,41 +579,53 @@ class AverageMeter(object):
         self.max = max(self.max, val)
 
 
-def patch_noise_to_sound(noise, waveform_length=16000, segment_location='center'):
-    # Init mask to zeroes
-    mask = np.zeros(waveform_length, dtype=np.float32)  
-    noise_length = noise.shape[0]
-    if segment_location == 'center' or (waveform_length == noise_length):
-        # Apply noise to the center of the waveform
-        start = (waveform_length - noise_length) // 2
-    elif segment_location == 'random':
-        # Apply noise to a random location in the waveform
-        start = np.random.randint(0, waveform_length - noise_length)
-    else:
-        raise ValueError('Invalid segment location')
+def apply_noise_patches(data, noise, placements):
+    # Add every sample's noise at its (start, end) to the whole batch with one scatter
+    positions = placements[:, :1].to(data.device) + torch.arange(noise.shape[1], device=data.device)
+    width = max(data.shape[2], int(placements[:, 1].max()))
+    patches = torch.zeros(data.shape[0], width, dtype=data.dtype, device=data.device)
+    patches.scatter_(1, positions, noise.to(data.device, data.dtype))
+    return data + patches[:, None, :data.shape[2]]
 
-    # Find end position (start+length), then check if its in bounds
-    end = start + noise_length
-    mask[start:end] = noise
-    return mask, (start, end)
- 
 
-idx_temp = 0
-mask_cord_list = []
-startAndEnd_list = []
-idx = 0
+def manifest_lengths(dataset):
+    # Number of samples of every clip, read from the WAV headers (no decoding)
+    lengths = []
+    for path in dataset._walker:
+        with wave.open(path) as fileobj:
+            lengths.append(fileobj.getnframes())
+    return lengths
 
 
-## Go through all batches of sound data and labels
-for data, labels in train_loader:
-    ## Go through each sound 
-    for i, (datum,label) in enumerate(zip(data,labels)):
-        # For each image, generate noise
-        noise = random_noise[idx].numpy() 
-        mask_cord, startAndEnd = patch_noise_to_sound(noise, waveform_length=datum.shape[1], segment_location='center') 
-        startAndEnd_list.append(startAndEnd)    #hold starts and end indicies
-        mask_cord_list.append(mask_cord)        #holds masks for each audio sample 
-        idx += 1
+def manifest_key(dataset, *params):
+    # Hash of the file list (path, size, mtime) and every parameter the cached values depend on
+    key = hashlib.sha256()
+    for path in dataset._walker:
+        stat = os.stat(path)
+        key.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    key.update(repr(params).encode())
+    return key.hexdigest()[:16]
+
+
+def load_or_compute(name, key, compute):
+    # Load a cached result keyed by its inputs, otherwise compute it and store it for the next run
+    cache_path = os.path.join(cache_dir, f"{name}_{key}.pt")
+    if use_cache and os.path.exists(cache_path):
+        print(f"Loaded cached {name} from {cache_path}", flush=True)
+        return torch.load(cache_path)
+    value = compute()
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(value, cache_path)
+        print(f"Cached {name} at {cache_path}", flush=True)
+    return value
+
+
+# Start/end of every sample's noise (clips shorter than SR are padded to SR by the loader)
+placement_key = manifest_key(train_set, noise_shape, patch_location, seed)
+placements = load_or_compute("placements", placement_key,
+                             lambda: placement_table(np.maximum(manifest_lengths(train_set), SR), noise_shape[1], patch_location, seed))
+torch.save(placements, os.path.join(ex_name, 'placement.pt'))
 
 
 
@@ -452,64 +643,21 @@ for data, labels in train_loader:
 ##########################################################
 ### TRAIN MODEL ON PERTURBATION ###
 ##########################################################
-def piecewise_eps_func(amp, eq, eps):
-        '''
-        # Mask is found for each segment and multiplied by the max epilson 
-        if amp < 0.005: # Minimum mask
-            return eps * 0.0615
-        elif amp > 0.3: # Maximum Epsilon 
-            return eps * 1
-        else:   # sigmoid calculated mask
-           # return eps * (eq[0] / (1 + np.exp((-1)*eq[1] * (amp - eq[2]))))
-           return eps * (eq[0]*amp + eq[1])
-        '''
-        # Mask is found for each segment based on its average amplitude, 
-        # Then is multiplied by Max Epsilon
-        if amp > 0.1:
-            return eps * 1          # 0.1
-        elif amp > .08: 
-            return eps * 0.538      # 0.07
-        elif amp > .05:
-            return eps * 0.3077     # 0.04
-        elif amp > .03:
-            return eps * 0.1538     # 0.02
-        elif amp > .01:
-            return eps * 0.0769     # 0.01
-        else:
-            return eps * 0.0385     # 0.005
-        
-    
-    
 def FindPrecompValues(train_loader):
-    precomputed_values = []
-    mean_amp_values = []
+    # One entry per sample id
+    precomputed_values = [None] * len(train_set)
     # Go through all batches
-    for batch_i, (data, labels) in tqdm(enumerate(train_loader), total = len(train_loader)):
+    for batch_i, (data, labels, ids) in tqdm(enumerate(train_loader), total = len(train_loader)):
         data,labels = data.to(device), labels.to(device)
-        batch_precomp_values = []
         current_batch_size, num_channels, audio_len = data.shape
         num_segments = audio_len // segment_size
         if audio_len % segment_size != 0:
             num_segments += 1  # Handle last partial segment
-        # Go through all samples
+        # (epsilon, step_size, startSeg, endSeg, mean_amp) of every segment of every sample, from the shared
+        # epsilon table (the same one perturbServer.py and streamPerturb.py use)
+        batch_precomp_values = compute_segment_values(data, segment_size, eps_max_value, step_size_factor)
         for b in range(current_batch_size):
-            sample_precomputed_values = []
-            # Go through all segments
-            for ind in range(num_segments):
-                startSeg = ind * segment_size
-                endSeg = min((ind + 1) * segment_size, audio_len)
-                segment = data[b:b+1, :, startSeg:endSeg]
-                
-                # Option 1: Find Mean to determine epsilon for each segment
-                mean_amp = segment.abs().mean().item()
-                epsilon = piecewise_eps_func(mean_amp, eps_linear_eq, eps_max_value)  # returns eps for this segment
-                # Set step_size based on epsilon and global factor
-                step_size = epsilon / step_size_factor
-
-                sample_precomputed_values.append((epsilon, step_size, startSeg, endSeg, mean_amp))
-                mean_amp_values.append(mean_amp)
-            batch_precomp_values.append(sample_precomputed_values)
-        precomputed_values.append(batch_precomp_values)
+            precomputed_values[ids[b].item()] = batch_precomp_values[b]
 
         # Save values for the first 3 elements in the last batch
         if batch_i == len(train_loader) - 1:
@@ -534,7 +682,6 @@ def FindPrecompValues(train_loader):
                     plt.axvline(x=seg_end, color='grey', linestyle='--', linewidth=0.5)
                     plt.text(seg_mid, 0.2, f'{batch_precomp_values[sample_idx][seg_idx][0]:.3f}', color='red', fontsize=8, verticalalignment='bottom', rotation=90)
                     plt.text(seg_mid, -0.2, f'{batch_precomp_values[sample_idx][seg_idx][4]:.4f}', color='blue', fontsize=8, verticalalignment='bottom', rotation=90)
-                    #plt.text(seg_mid, 0.4, f'{mean_amp_values[sample_idx * num_segments + seg_idx]:.4f}', color='blue', fontsize=8, verticalalignment='bottom')
                     plt.hlines(batch_precomp_values[sample_idx][seg_idx][0], seg_start, seg_end, colors='red', linestyles='-', linewidth=1)
 
                 plt.savefig(f'sample-noise-2/plot{sample_idx}.png')
@@ -545,40 +692,52 @@ def FindPrecompValues(train_loader):
 
 ## Training phase for MIN-MIN Attack: applies noise to each sound, then trains
 ## the model on the noisy sounds
-condition = True
-train_idx = 0
+condition = len(attack_set) > 0     # an incremental run without new clips has nothing to attack
 data_iter = iter(train_loader) #to loop over dataset in batches
-clean_waveform_list =[]
-noisy_waveform_list = []
 print('=' * 20 + 'Searching Samplewise Perturbuations' + '=' * 20, flush=True)
 
 # Find the epsilon, start, end, etc for each segment in each sample/batch
-precomputed_values = FindPrecompValues(train_loader)
+attack_ids = attack_set.indices if incremental else None
+precomp_key = manifest_key(train_set, SR, segment_size, eps_max_value, step_size_factor, inspect.getsource(piecewise_eps_func), EPS_TIERS, inspect.getsource(compute_segment_values), inspect.getsource(FindPrecompValues), attack_ids)
+precomputed_values = load_or_compute("precomputed_values", precomp_key, lambda: FindPrecompValues(attack_loader))
+
+# Distribution of segment amplitudes and chosen epsilon tiers (one bin per EPS_TIERS tier)
+amp_edges, eps_edges = eps_tier_edges(eps_max_value)
+amp_stats = RunningStats('segment amplitude', amp_edges)
+eps_stats = RunningStats('segment epsilon', eps_edges)
+for sample_precomputed_values in filter(None, precomputed_values):
+    amp_stats.update([values[4] for values in sample_precomputed_values])
+    eps_stats.update([values[0] for values in sample_precomputed_values])
+print(amp_stats.summary(), flush=True)
+print(eps_stats.summary(), flush=True)
+
+def current_resolution(outer_iter):
+    # Noise resolution factor of this outer iteration under resolution_schedule (1 = full resolution)
+    for factor, iterations in resolution_schedule:
+        if outer_iter < iterations:
+            return factor
+        outer_iter -= iterations
+    return 1
+
 
 # Do while threshold has not been met
+outer_iter = 0
+example_batch = next(iter(attack_loader))[0][:8].to(device) if condition else None    # real clips to check the folded surrogate on
 while condition:
     ## Step 1: Iterate though Batches and it's data- adding noise and training
     for j in tqdm(range(train_step)):
         ## Attempt to load next batch of sounds/labels
         try:
-            (data,labels) = next(data_iter)
+            (data,labels,ids) = next(data_iter)
         except: 
-            train_idx = 0
             data_iter = iter(train_loader)
-            (data,labels) = next(data_iter)
+            (data,labels,ids) = next(data_iter)
 
         # Move data to device and add noise
         data,labels = data.to(device), labels.to(device)
 
         ## 1: Add noise to each sample
-        for i, (datum,label) in enumerate(zip(data,labels)): #iterate over sound in current batch
-            sample_noise = random_noise[train_idx]
-            mask = np.zeros(datum.shape[1], np.float32)
-            start,end = startAndEnd_list[train_idx]
-            mask[start:end] = sample_noise.cpu().numpy()
-            sample_noise = torch.from_numpy(mask).to(device)
-            data[i] = data[i] + sample_noise
-            train_idx += 1
+        data = apply_noise_patches(data, random_noise[ids], placements[ids])
            
 
         ## 2: Train the batch on NOISY DATA
@@ -587,50 +746,54 @@ while condition:
             param.requires_grad = True
         model.zero_grad()
         optimizer.zero_grad()
-        output = model(data)
-        loss = criterion(output.squeeze(),labels)
+        if ensemble_size > 1:
+            # Each surrogate is trained on the same noisy batch with its own loss
+            loss = sum(criterion(member(data).squeeze(), labels) for member in model.members)
+        else:
+            output = model(data)
+            loss = criterion(output.squeeze(),labels)
         loss.backward()
         optimizer.step()
 
     ## STEP 2: Seach for perturbations (noise) and update noise on min-min
-    idx = 0
-    for batch_i, (data,labels) in tqdm(enumerate(train_loader), total=len(train_loader)):
+    steps_used = []
+    resolution = current_resolution(outer_iter)
+    if resolution > 1:
+        print(f"Coarse search: one noise value per {resolution} samples", flush=True)
+    if ensemble_size > 1:
+        model.restack()     # attack against the freshly trained surrogates
+        attack_model = model
+    else:
+        # Frozen BatchNorm-folded copy for the ~num_steps forward/backward passes per batch
+        attack_model = export_inference_m5(model, example_batch, use_jit=inference_jit)
+    for batch_i, (data,labels,ids) in tqdm(enumerate(attack_loader), total=len(attack_loader)):
         data, labels = data.to(device), labels.to(device)
-        batch_noise, batch_start_idx = [], idx
-        precomputed_batch = precomputed_values[batch_i]
-        # Iterate over audio in current batch
-        for j, datum in enumerate(data):
-            sample_noise = random_noise[idx]
-            mask = np.zeros(datum.shape[1], np.float32)
-            start,end = startAndEnd_list[idx]
-            mask[start:end] = sample_noise.cpu().numpy()
-            sample_noise = torch.from_numpy(mask).to(device)
-        
-            datum_cpu = datum.cpu().numpy()
-            clean_waveform_list.append(datum_cpu)  # Add clean waveform to list
-
-            noisy_waveform = datum_cpu + mask  # Add noise to waveform
-            noisy_waveform = torch.tensor(noisy_waveform).to(device)
-            batch_noise.append(noisy_waveform)
-            idx += 1
+        precomputed_batch = [precomputed_values[i] for i in ids.tolist()]
+        # Noisy waveforms of the current batch
+        batch_noise = apply_noise_patches(data, random_noise[ids], placements[ids])
 
         #Eval the model
         model.eval()
         for param in model.parameters():
             param.requires_grad = False
         ## MIN-MIN Attack
-        batch_noise = torch.stack(batch_noise)
-        attack = PerturbationTool(eps_cutoff, segment_size, step_size_factor, train_step)
-        perturb_audio, eta = attack.min_min_attack(data, labels, model, optimizer, criterion, batch_i, random_noise=batch_noise, precomputed_values=precomputed_batch)
+        attack = PerturbationTool(eps_cutoff, segment_size, step_size_factor, train_step, adaptive=adaptive_steps,
+                                  loss_tol=adaptive_loss_tol, change_tol=adaptive_change_tol, momentum=momentum_decay, resolution=resolution)
+        batch_momentum = None
+        if momentum_decay > 0:
+            batch_momentum = grad_momentum_store[ids, :, :data.shape[2]].to(device)
+        perturb_audio, eta = attack.min_min_attack(data, labels, attack_model, optimizer, criterion, batch_i, random_noise=batch_noise, precomputed_values=precomputed_batch, grad_momentum=batch_momentum)
+        steps_used.append(attack.steps_used)
+        if momentum_decay > 0:
+            grad_momentum_store[ids, :, :data.shape[2]] = attack.grad_momentum.cpu()
 
         ## OUTPUT is perturb_audio and eta (eta = delta, perturb is x+eta)
-        for i, delta in enumerate(eta):
-            mask_cord = mask_cord_list[batch_start_idx + i]
-            delta_cpu = delta.detach().cpu().numpy() # move delta tensor to CPU
-            random_noise[batch_start_idx + i] = torch.tensor(delta_cpu).to(device) #Was just delta
+        random_noise[ids, :eta.shape[2]] = eta[:, 0].detach().cpu()
 
 
-    loss_avg, error_rate = perturb_eval(random_noise, train_loader,model,startAndEnd_list=startAndEnd_list, mask_cord_list=mask_cord_list)
+    print(f"Avg min-min steps per batch: {np.mean(steps_used):.1f}/{train_step}", flush=True)
+    outer_iter += 1
+    loss_avg, error_rate = perturb_eval(random_noise, attack_loader,attack_model,placements=placements)
     print('Loss: {:.4f} Acc: {:.2f}%'.format(loss_avg, 100 - error_rate * 100), flush=True)
 
  
@@ -672,19 +835,13 @@ while condition:
 # Finale Noise Update to Audio
 if torch.is_tensor(random_noise):
     new_random_noise = []
-    # Iterate over random_noise
-    for idx in range(len(random_noise)):
-        sample_noise = random_noise[idx]
-        # Get waveform length and create zero mask of same size
-        waveform_length = data.shape[2] #CHANGED, was [1]
-        mask = np.zeros((waveform_length), np.float32)
-        # Get coords of segment and ple noise in location
-        start,end = startAndEnd_list[idx]
-        mask[start:end] = sample_noise.cpu().numpy()
-        #Convert back to tensor and add to list
-        new_random_noise.append(torch.from_numpy(mask))
+    # Place the noise in a zero waveform, one batch at a time
+    for start in range(0, len(random_noise), batch_size):
+        rows = slice(start, start + batch_size)
+        zeros = torch.zeros(len(random_noise[rows]), 1, SR)
+        new_random_noise.append(apply_noise_patches(zeros, random_noise[rows], placements[rows])[:, 0])
     # Stack list of noises tensors into single tensor
-    new_random_noise=torch.stack(new_random_noise)
+    new_random_noise=torch.cat(new_random_noise)
     random_noise = new_random_noise
 #else: random noise isnt a tensor, dont change it
     
@@ -693,9 +850,18 @@ print(f"Final random_noise shape: {random_noise.shape}")
 first_noise = random_noise[0].cpu()
 torchaudio.save('test-testing/END_first_noisy_sample.wav', first_noise.unsqueeze(0), SR)
 torch.save(random_noise, os.path.join(ex_name, 'perturbation.pt'))
-print(noise)
-print(noise.shape)
+torch.save(torch.tensor(target_idx), os.path.join(ex_name, 'perturbation_ids.pt'))   # noise row -> training sample id
+# Clip of every noise row (and the whole training list) so a later incremental run can detect new/changed clips
+torch.save({'paths': train_set._walker, 'fingerprints': [file_fingerprint(path) for path in train_set._walker],
+            'training_paths': training_paths, 'refresh_round': refresh_round + 1 if incremental else 0}, manifest_path)
+print(random_noise[-1])
+print(random_noise[-1].shape)
 print('Noise saved at %s ' % (os.path.join(ex_name, 'perturbation.pt')), flush=True)
+
+## Save the surrogate(s) the noise was optimized against (used by perturbServer.py)
+surrogates = model.members if ensemble_size > 1 else [model]
+torch.save({'labels': label_types, 'state_dicts': [m.state_dict() for m in surrogates]}, os.path.join(ex_name, 'surrogate.pt'))
+print('Surrogate saved at %s ' % (os.path.join(ex_name, 'surrogate.pt')), flush=True)
 print(f"VARIABLES: \n Target_Loss: {target_error_rate}% \n  Number of steps: {train_step}", flush=True)
 print(f"n_channel: 32 \n Step Size: {step_size_factor} \n Eps_cutoff: {eps_cutoff} \n Segment Size: {segment_size}", flush=True)
 print(f"(MASK) Max Eps: {eps_max_value}", flush=True)
@@ -0,0 +1,117 @@
+'''
+    Description: Perturbs arbitrarily long recordings (minutes to hours) with the frozen surrogate M5 from
+                 speechClass.py. The recording is read and written incrementally, attacked in overlapping 1-second
+                 windows with the same segment-wise epsilon, and the noise of neighbouring windows is cross-faded
+                 in the overlaps. Memory stays constant regardless of the recording length.
+    Requires: experiments/surrogate.pt (from speechClass.py), 16 kHz PCM16 WAV input
+    Usage: python streamPerturb.py input.wav output.wav
+    Date: 10/19/2026
+'''
+import torch
+import torch.nn as nn
+import numpy as np
+import sys
+import wave
+
+from tqdm import tqdm
+from surrogate_tools import load_surrogate, compute_segment_values, BatchedMinMinAttack
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+####################################
+##   VARIABLES: CHANGE AS NEEDED  ##
+####################################
+input_path = "long_recording.wav"
+output_path = "long_recording_perturbed.wav"
+surrogate_path = "experiments/surrogate.pt"
+overlap = 4000                  # samples shared by neighbouring windows (cross-faded), at most half a window
+batch_windows = 16              # windows attacked together
+inference_jit = False           # trace + freeze the BatchNorm-folded surrogate (oneDNN conv+ReLU fusion)
+# Noise Variables (MATCH speechClass.py)
+eps_max_value = 0.13
+step_size_factor = 25
+segment_size = 1000
+train_step = 20
+SR = 16000                      # window length = one clip of the surrogate
+
+if len(sys.argv) > 2:
+    input_path, output_path = sys.argv[1], sys.argv[2]
+
+hop = SR - overlap
+if overlap > SR // 2 or hop % segment_size != 0:
+    # Windows must share segment boundaries so both windows of an overlap use the same epsilon there
+    raise ValueError('overlap must be at most SR/2 and leave a hop that is a multiple of segment_size')
+
+
+
+
+#######################################################################################################
+### STREAMING ###
+#######################################################################################################
+def perturb_windows(windows, model, attack, criterion):
+    # Noise for a batch of mono windows (B x SR), pushed towards the surrogate's own prediction
+    data = torch.from_numpy(windows).unsqueeze(1).to(device)
+    precomputed_values = compute_segment_values(data, segment_size, eps_max_value, step_size_factor)
+    with torch.no_grad():
+        labels = model(data).squeeze(1).argmax(dim=-1)
+    _, eta = attack.attack(data, labels, model, criterion, precomputed_values, init_noise=torch.zeros_like(data))
+    return eta[:, 0].cpu().numpy()
+
+
+def stream_perturb(input_path, output_path, model):
+    attack = BatchedMinMinAttack(train_step)
+    criterion = nn.CrossEntropyLoss()
+    fade_in = np.linspace(0, 1, overlap + 2, dtype=np.float32)[1:-1]   # fade_in + fade_out = 1 in every overlap
+    fade_out = 1 - fade_in
+
+    with wave.open(input_path, 'rb') as reader, wave.open(output_path, 'wb') as writer:
+        if reader.getsampwidth() != 2 or reader.getframerate() != SR:
+            raise ValueError(f'Expected {SR} Hz PCM16 audio')
+        num_channels = reader.getnchannels()
+        total_frames = reader.getnframes()
+        writer.setnchannels(num_channels)
+        writer.setsampwidth(2)
+        writer.setframerate(SR)
+        num_windows = max(1, -(-max(total_frames - overlap, 1) // hop))
+
+        # Rolling buffer of the input (channels x frames) starting at frame buffer_start
+        buffer = np.zeros((num_channels, 0), dtype=np.float32)
+        buffer_start = 0
+        pending = np.zeros(overlap, dtype=np.float32)   # faded-out tail of the previous window's noise
+
+        for first in tqdm(range(0, num_windows, batch_windows), desc="Windows"):
+            batch = range(first, min(first + batch_windows, num_windows))
+            # Read just enough audio for this batch of windows
+            needed = min(batch[-1] * hop + SR, total_frames) - (buffer_start + buffer.shape[1])
+            if needed > 0:
+                frames = np.frombuffer(reader.readframes(needed), dtype='<i2').astype(np.float32) / 32768
+                buffer = np.concatenate([buffer, frames.reshape(-1, num_channels).T], axis=1)
+            windows = np.zeros((len(batch), SR), dtype=np.float32)
+            for i, k in enumerate(batch):
+                chunk = buffer[:, k * hop - buffer_start:k * hop - buffer_start + SR].mean(axis=0)
+                windows[i, :len(chunk)] = chunk
+            noise = perturb_windows(windows, model, attack, criterion)
+
+            # Cross-fade with the neighbours and write every frame that no later window touches anymore
+            for i, k in enumerate(batch):
+                window_noise = noise[i]
+                if k > 0:
+                    window_noise[:overlap] *= fade_in
+                    window_noise[:overlap] += pending
+                last = k == num_windows - 1
+                out_len = (total_frames - k * hop) if last else hop
+                if not last:
+                    pending = window_noise[hop:] * fade_out
+                audio = buffer[:, k * hop - buffer_start:k * hop - buffer_start + out_len]
+                perturbed = np.clip(audio + window_noise[:out_len], -1, 1)
+                writer.writeframes((perturbed.T * 32767).round().astype('<i2').tobytes())
+
+            # Drop audio that has been written
+            written = (batch[-1] + 1) * hop
+            buffer = buffer[:, max(0, written - buffer_start):]
+            buffer_start = max(buffer_start, written)
+    print(f"Perturbed {total_frames / SR:.1f}s of audio ({num_windows} windows) -> {output_path}", flush=True)
+
+
+model, label_types = load_surrogate(surrogate_path, device, use_jit=inference_jit, SR=SR)
+stream_perturb(input_path, output_path, model)
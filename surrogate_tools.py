@@ -0,0 +1,268 @@
+'''
+    Description: Shared, import-only helpers for the scripts that run the frozen surrogate M5 saved by speechClass.py
+                 (perturbServer.py, streamPerturb.py): the M5 network, BatchNorm folding / inference export, surrogate
+                 loading, the segment epsilon table, a batched min-min attack, the noise placement table and the
+                 streaming noise statistics.
+                 speechClass.py, trainPerturb.py and sweepRunner.py import the parts they share from here. Importing this module has no side effects.
+    Requires: experiments/surrogate.pt (from speechClass.py) for load_surrogate
+    Date: 10/19/2026
+'''
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+import copy
+
+
+
+
+#####################################################################################################
+## DEFINE the Network (CNN)
+#####################################################################################################
+class M5(nn.Module):
+    def __init__(self, n_input=1, n_output=35, stride=16, n_channel=32):
+        super().__init__()
+        self.conv1 = nn.Conv1d(n_input, n_channel, kernel_size=80, stride=stride)
+        self.bn1 = nn.BatchNorm1d(n_channel)
+        self.pool1 = nn.MaxPool1d(4)
+        self.conv2 = nn.Conv1d(n_channel, n_channel, kernel_size=3)
+        self.bn2 = nn.BatchNorm1d(n_channel)
+        self.pool2 = nn.MaxPool1d(4)
+        self.conv3 = nn.Conv1d(n_channel, 2 * n_channel, kernel_size=3)
+        self.bn3 = nn.BatchNorm1d(2 * n_channel)
+        self.pool3 = nn.MaxPool1d(4)
+        self.conv4 = nn.Conv1d(2 * n_channel, 2 * n_channel, kernel_size=3)
+        self.bn4 = nn.BatchNorm1d(2 * n_channel)
+        self.pool4 = nn.MaxPool1d(4)
+        self.fc1 = nn.Linear(2 * n_channel, n_output)
+
+    def forward(self, x):
+        x = self.conv1(x)
+        x = F.relu(self.bn1(x))
+        x = self.pool1(x)
+        x = self.conv2(x)
+        x = F.relu(self.bn2(x))
+        x = self.pool2(x)
+        x = self.conv3(x)
+        x = F.relu(self.bn3(x))
+        x = self.pool3(x)
+        x = self.conv4(x)
+        x = F.relu(self.bn4(x))
+        x = self.pool4(x)
+        x = F.avg_pool1d(x, x.shape[-1])
+        x = x.permute(0, 2, 1)
+        x = self.fc1(x)
+        return F.log_softmax(x, dim=2)
+
+
+def fold_batchnorm(model):
+    # Copy of a trained M5 (or trainPerturb.py's StackedM5) with every BatchNorm folded into the conv before it (eval-mode statistics)
+    folded = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        for i in range(1, 5):
+            conv, bn = getattr(folded, f'conv{i}'), getattr(folded, f'bn{i}')
+            scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+            conv.weight.mul_(scale[:, None, None])
+            conv.bias.copy_((conv.bias - bn.running_mean) * scale + bn.bias)
+            setattr(folded, f'bn{i}', nn.Identity())
+    for param in folded.parameters():
+        param.requires_grad = False
+    return folded
+
+
+def export_inference_m5(model, example_input, use_jit=False, rtol=1e-3):
+    # Frozen inference variant of a trained M5: BatchNorm folded, optionally traced + frozen so the CPU backend
+    # (oneDNN) can fuse conv+ReLU. Checked against the original on example_input (preferably a real batch); if the
+    # largest difference exceeds rtol of the output scale, it warns and returns a frozen unfolded eval() copy instead.
+    was_training = model.training
+    model.eval()
+    inference_model = fold_batchnorm(model)
+    if use_jit:
+        inference_model = torch.jit.freeze(torch.jit.trace(inference_model, example_input))
+    with torch.no_grad():
+        expected = model(example_input)
+        actual = inference_model(example_input)
+    model.train(was_training)
+    error = (expected - actual).abs().max().item() / max(expected.abs().max().item(), 1e-12)
+    if error > rtol:
+        print(f"WARNING: folded inference M5 differs from the original by {error:.2e} (relative), using the unfolded model", flush=True)
+        inference_model = copy.deepcopy(model).eval()
+        for param in inference_model.parameters():
+            param.requires_grad = False
+    return inference_model
+
+
+def load_surrogate(path, device, use_jit=False, SR=16000, example_input=None):
+    # Frozen surrogate: first model of the checkpoint, BatchNorm folded, no parameter gradients
+    # (example_input: clips to check the folding on, speech-like noise if not given)
+    checkpoint = torch.load(path, map_location=device)
+    label_types = checkpoint['labels']
+    model = M5(n_input=1, n_output=len(label_types))
+    model.load_state_dict(checkpoint['state_dicts'][0])
+    model.to(device)
+    if example_input is None:
+        example_input = torch.randn(4, 1, SR, device=device) * 0.1
+    model = export_inference_m5(model, example_input.to(device), use_jit=use_jit)
+    return model, label_types
+
+
+
+
+#######################################################################################################
+### ADD PERTURBATION/NOISE ###
+#######################################################################################################
+# Segment epsilon tiers, loudest first: (mean amplitude the segment must exceed, fraction of the max epsilon).
+# The last tier takes every remaining segment. Tune the thresholds here, the stats histograms follow.
+EPS_TIERS = [(0.1, 1), (0.08, 0.538), (0.05, 0.3077), (0.03, 0.1538), (0.01, 0.0769), (float('-inf'), 0.0385)]
+
+
+def piecewise_eps_func(amp, eq, eps):
+        # Mask is found for each segment based on its average amplitude,
+        # Then is multiplied by Max Epsilon
+        for threshold, factor in EPS_TIERS:
+            if amp > threshold:
+                return eps * factor
+        return eps * EPS_TIERS[-1][1]
+
+
+def eps_tier_edges(eps_max):
+    # Histogram edges with one bin per tier: amplitude thresholds, and epsilons halfway between neighbouring tiers
+    amp_edges = sorted(threshold for threshold, _ in EPS_TIERS[:-1])
+    factors = sorted(factor for _, factor in EPS_TIERS)
+    eps_edges = [eps_max * (low + high) / 2 for low, high in zip(factors[:-1], factors[1:])]
+    return amp_edges, eps_edges
+
+
+def compute_segment_values(data, segment_size, eps_max_value, step_size_factor):
+    # (epsilon, step_size, startSeg, endSeg, mean_amp) of every segment of every sample in one batch
+    # (FindPrecompValues in speechClass.py builds its table with this as well)
+    current_batch_size, num_channels, audio_len = data.shape
+    num_segments = audio_len // segment_size
+    if audio_len % segment_size != 0:
+        num_segments += 1  # Handle last partial segment
+    mean_amps = [data[:, :, ind * segment_size:(ind + 1) * segment_size].abs().mean(dim=(1, 2)).tolist() for ind in range(num_segments)]
+    precomputed_values = []
+    for b in range(current_batch_size):
+        sample_precomputed_values = []
+        for ind in range(num_segments):
+            startSeg = ind * segment_size
+            endSeg = min((ind + 1) * segment_size, audio_len)
+            mean_amp = mean_amps[ind][b]
+            epsilon = piecewise_eps_func(mean_amp, None, eps_max_value)
+            step_size = epsilon / step_size_factor
+            sample_precomputed_values.append((epsilon, step_size, startSeg, endSeg, mean_amp))
+        precomputed_values.append(sample_precomputed_values)
+    return precomputed_values
+
+
+class BatchedMinMinAttack:
+    '''Min-min attack against a frozen model for a whole batch at once: the per-segment epsilon and step size are
+    expanded into per-sample tensors, so every step is one forward/backward and one clamp over the batch.
+    Unlike PerturbationTool.min_min_attack in speechClass.py (which is given the noisy audio), init_noise is
+    the raw starting noise (delta), added to the clean audio.'''
+    def __init__(self, num_steps, init_epsilon=0.01):
+        self.num_steps = num_steps
+        self.init_epsilon = init_epsilon
+
+    def attack(self, audio_samples, labels, model, criterion, precomputed_values, init_noise=None):
+        # audio_samples: (batch x 1 x length) clean audio, precomputed_values: one compute_segment_values entry
+        # per sample. Returns (perturbed audio, noise)
+        eps = torch.zeros_like(audio_samples)
+        step = torch.zeros_like(audio_samples)
+        for b, sample_precomputed_values in enumerate(precomputed_values):
+            for epsilon, step_size, startSeg, endSeg, _ in sample_precomputed_values:
+                eps[b, :, startSeg:endSeg] = epsilon
+                step[b, :, startSeg:endSeg] = step_size
+
+        if init_noise is None:
+            init_noise = torch.empty_like(audio_samples).uniform_(-self.init_epsilon, self.init_epsilon)
+        eta = torch.clamp(init_noise, -eps, eps)
+        perturb_audio = torch.clamp(audio_samples + eta, -1, 1)
+
+        for _ in range(self.num_steps):
+            perturb_audio = perturb_audio.detach().requires_grad_(True)
+            logits = model(perturb_audio).squeeze(1)
+            loss = criterion(logits, labels)
+            grad, = torch.autograd.grad(loss, perturb_audio)
+            perturb_audio = perturb_audio.detach() - step * grad.sign()
+            eta = torch.clamp(perturb_audio - audio_samples, -eps, eps)
+            perturb_audio = torch.clamp(audio_samples + eta, -1, 1)
+        return perturb_audio, eta
+
+
+
+
+#######################################################################################################
+### NOISE PLACEMENT ###
+#######################################################################################################
+def placement_table(lengths, noise_length, segment_location='center', seed=0):
+    # (start, end) of the noise in every sample, for all N samples at once (waveforms shorter than the noise count as noise_length)
+    waveform_lengths = np.maximum(np.asarray(lengths, dtype=np.int64), noise_length)
+    room = waveform_lengths - noise_length
+    # Apply noise to the center of the waveform
+    starts = room // 2
+    if segment_location == 'random':
+        # Apply noise to a (seeded) random location in the waveform, center if it fills the waveform
+        random_starts = np.random.RandomState(seed).randint(0, np.maximum(room, 1))
+        starts = np.where(room > 0, random_starts, starts)
+    elif segment_location != 'center':
+        raise ValueError('Invalid segment location')
+    starts = torch.from_numpy(starts)
+    return torch.stack([starts, starts + noise_length], dim=1)
+
+
+
+
+#######################################################################################################
+### NOISE STATISTICS ###
+#######################################################################################################
+class RunningStats(object):
+    """Streaming mean/variance (Welford, merged per batch) and fixed-bin histogram of a scalar"""
+
+    def __init__(self, name, edges):
+        self.name = name
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        batch_mean = values.mean()
+        delta = batch_mean - self.mean
+        total = self.count + len(values)
+        self.mean += delta * len(values) / total
+        self.m2 += ((values - batch_mean) ** 2).sum() + delta ** 2 * self.count * len(values) / total
+        self.count = total
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.counts += np.bincount(np.searchsorted(self.edges, values, side='right'), minlength=len(self.counts))
+
+    def std(self):
+        return (self.m2 / self.count) ** 0.5 if self.count else 0.0
+
+    def summary(self):
+        bounds = ['-inf'] + [f'{edge:.4g}' for edge in self.edges] + ['inf']
+        hist = ' '.join(f'[{bounds[i]},{bounds[i + 1]}):{count}' for i, count in enumerate(self.counts))
+        return f'{self.name}: n={self.count} mean={self.mean:.4g} std={self.std():.4g} min={self.min:.4g} max={self.max:.4g} | {hist}'
+
+
+def noise_stats(eps_max):
+    # Per-sample noise L-inf, L2 and SNR (dB) of the perturbed audio
+    return [RunningStats('noise Linf', eps_max * np.array([0.25, 0.5, 0.75, 1.0])),
+            RunningStats('noise L2', [0.1, 0.5, 1, 2, 5]),
+            RunningStats('SNR dB', [0, 10, 20, 30, 40])]
+
+
+def update_noise_stats(stats, clean, noise):
+    clean, noise = clean.detach().flatten(1).float(), noise.detach().flatten(1).float()
+    linf_stats, l2_stats, snr_stats = stats
+    linf_stats.update(noise.abs().max(dim=1).values.cpu().numpy())
+    l2_stats.update(noise.norm(dim=1).cpu().numpy())
+    snr = 10 * torch.log10(clean.pow(2).sum(dim=1).clamp_min(1e-12) / noise.pow(2).sum(dim=1).clamp_min(1e-12))
+    snr_stats.update(snr.cpu().numpy())
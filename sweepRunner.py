@@ -0,0 +1,229 @@
+'''
+    Description: Runs a grid of victim-training experiments (poison_rate, seed, n_epoch, perturbation file) in parallel
+                 and writes the accuracy curve of every run into one results table.
+                 Follows trainPerturb.py's rules: poison targets drawn with RandomState(seed) among the samples that
+                 have noise, noise added to the (mono) clip standardized to SR and clipped to [-1, 1], batches padded
+                 to their longest clip (SR as soon as one sample is poisoned), test batches of batch_size in test
+                 order padded to their longest clip. Differences: trainPerturb.py's transform is an identity Resample
+                 and is skipped, shuffling uses torch.randperm instead of the DataLoader's sampler (runs with the same
+                 seed are statistically, not bitwise, comparable), and the test accuracy is computed on the eval()
+                 model instead of its BatchNorm-folded export.
+    Requires: SpeechCommands dataset, perturbation file(s) from speechClass.py, data_seed that MATCHES the one used in
+              speechClass.py, optional sweep.yaml grid (loaded with mlconfig)
+    Date: 10/19/2026
+'''
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+import os
+import csv
+import time
+import itertools
+import mlconfig
+import numpy as np
+import random
+
+from torchaudio.datasets import SPEECHCOMMANDS
+from tqdm import tqdm
+from surrogate_tools import M5
+
+###################################
+## VARIABLES ##
+###################################
+grid_path = "sweep.yaml"        # mlconfig/yaml file holding the grid (falls back to default_grid if missing)
+default_grid = {
+    "perturb_tensor_path": ["experiments/perturbation.pt"],
+    "poison_rate": [0.2, 0.5, 1.0],
+    "seed": [0, 1, 2],          # seed of the run (model init, poison targets, shuffling)
+    "n_epoch": [10],
+}
+results_path = "experiments/sweep_results.csv"
+batch_size = 256
+num_procs = 0                   # worker processes, 0 = one per core (capped by number of runs)
+## MAKE SURE DATA SEED MATCHES IN PERTURBATION GENERATION CODE!!!
+data_seed = 8
+SR = 16000
+
+
+
+
+class SubsetSC(SPEECHCOMMANDS):
+    def __init__(self, subset: str = None):
+        super().__init__("./", download=True)
+
+        def load_list(filename):
+            filepath = os.path.join(self._path, filename)
+            with open(filepath) as fileobj:
+                return [os.path.normpath(os.path.join(self._path, line.strip())) for line in fileobj]
+
+        if subset == "validation":
+            self._walker = load_list("validation_list.txt")
+        elif subset == "testing":
+            self._walker = load_list("testing_list.txt")
+        elif subset == "training":
+            excludes = load_list("validation_list.txt") + load_list("testing_list.txt")
+            excludes = set(excludes)
+            self._walker = [w for w in self._walker if w not in excludes]
+            random.seed(data_seed)
+            random.shuffle(self._walker)
+
+
+
+
+###############################################################################
+## LOAD GRID
+###############################################################################
+if os.path.exists(grid_path):
+    grid = dict(mlconfig.load(grid_path))
+else:
+    grid = dict(default_grid)
+# Allow single values in the grid file
+grid = {key: (list(value) if isinstance(value, (list, tuple)) else [value]) for key, value in grid.items()}
+for key in default_grid:
+    grid.setdefault(key, default_grid[key])
+
+grid_keys = list(grid.keys())
+configs = [dict(zip(grid_keys, values)) for values in itertools.product(*(grid[key] for key in grid_keys))]
+print(f"Sweep: {len(configs)} runs over {grid_keys}", flush=True)
+
+
+
+
+###############################################################################
+## DECODE DATASETS ONCE (shared read-only between workers)
+###############################################################################
+def decode_subset(subset):
+    # Decode every clip once, padded/truncated to SR samples, into shared memory (SpeechCommands clips are mono)
+    dataset = SubsetSC(subset)
+    data = torch.zeros(len(dataset), 1, SR).share_memory_()
+    lengths = torch.zeros(len(dataset), dtype=torch.long).share_memory_()
+    label_names = []
+    for i in tqdm(range(len(dataset)), desc=f"Decoding {subset}"):
+        waveform, _, label, *_ = dataset[i]
+        length = min(waveform.shape[1], SR)
+        data[i, :, :length] = waveform[:1, :length]
+        lengths[i] = length
+        label_names.append(label)
+    return data, lengths, label_names
+
+
+train_data, train_lengths, train_label_names = decode_subset("training")
+test_data, test_lengths, test_label_names = decode_subset("testing")
+
+# Contains names of all sound labels
+label_types = sorted(set(train_label_names))
+train_labels = torch.tensor([label_types.index(label) for label in train_label_names]).share_memory_()
+test_labels = torch.tensor([label_types.index(label) for label in test_label_names]).share_memory_()
+
+# Load every perturbation store once, with its id -> row mapping if the noise only covers a subset
+perturbations = {}
+perturb_ids = {}
+for path in grid["perturb_tensor_path"]:
+    perturbations[path] = torch.load(path, map_location="cpu").float().share_memory_()
+    ids_path = os.path.join(os.path.dirname(path), "perturbation_ids.pt")
+    if os.path.exists(ids_path):
+        perturb_ids[path] = torch.load(ids_path).long()
+    print(f"Loaded {path}: {tuple(perturbations[path].shape)}", flush=True)
+
+
+
+
+##########################
+## RUN ONE CONFIGURATION ##
+##########################
+cpu_count = os.cpu_count() or 1
+if num_procs <= 0:
+    num_procs = cpu_count
+num_procs = max(1, min(num_procs, len(configs)))
+threads_per_run = max(1, cpu_count // num_procs)
+
+
+def evaluate(model):
+    model.eval()
+    correct = 0
+    with torch.no_grad():
+        for start in range(0, len(test_data), batch_size):
+            # Same batches as trainPerturb.py's test_loader: padded to their longest clip
+            batch_len = int(test_lengths[start:start + batch_size].max())
+            output = model(test_data[start:start + batch_size, :, :batch_len])
+            correct += output.argmax(dim=-1).squeeze(1).eq(test_labels[start:start + batch_size]).sum().item()
+    return 100. * correct / len(test_data)
+
+
+def run_config(cfg):
+    torch.set_num_threads(threads_per_run)
+    torch.manual_seed(cfg["seed"])
+    rng = np.random.RandomState(cfg["seed"])
+    noise = perturbations[cfg["perturb_tensor_path"]]
+    num_train = len(train_data)
+
+    # Noise row of every training sample (-1 = no noise generated for it)
+    if cfg["perturb_tensor_path"] in perturb_ids:
+        ids = perturb_ids[cfg["perturb_tensor_path"]]
+        noise_rows = torch.full((num_train,), -1, dtype=torch.long)
+        noise_rows[ids] = torch.arange(len(ids))
+        targets = ids.numpy()
+    else:
+        noise_rows = torch.arange(num_train) % len(noise)
+        targets = np.arange(num_train)
+
+    # Randomly selected poison targets (same rule as PoisonSC)
+    poison_samples_idx = rng.choice(targets, min(int(num_train * cfg["poison_rate"]), len(targets)), replace=False)
+    poison_mask = torch.zeros(num_train, dtype=torch.bool)
+    poison_mask[torch.from_numpy(poison_samples_idx)] = True
+
+    model = M5(n_input=1, n_output=len(label_types))
+    optimizer = optim.Adam(model.parameters(), lr=0.01, weight_decay=0.0001)
+    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=20, gamma=0.1)
+
+    total_acc = []
+    start_time = time.time()
+    for epoch in range(1, cfg["n_epoch"] + 1):
+        model.train()
+        order = torch.randperm(num_train)
+        for start in range(0, num_train, batch_size):
+            batch_idx = order[start:start + batch_size]
+            poisoned = poison_mask[batch_idx]
+            # Padded to the longest clip of the batch, poisoned clips are standardized to SR (as in PoisonSC)
+            batch_len = SR if poisoned.any() else int(train_lengths[batch_idx].max())
+            data = train_data[batch_idx, :, :batch_len]    # gathered copy, shared store stays untouched
+            if poisoned.any():
+                rows = noise_rows[batch_idx[poisoned]]
+                data[poisoned, 0] = torch.clamp(data[poisoned, 0] + noise[rows], -1, 1)
+
+            output = model(data)
+            loss = F.nll_loss(output.squeeze(1), train_labels[batch_idx])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        scheduler.step()
+        total_acc.append(evaluate(model))
+    return cfg, total_acc, time.time() - start_time
+
+
+
+
+##########################
+## RUN SWEEP ##
+##########################
+print(f"Running {len(configs)} runs on {num_procs} processes ({threads_per_run} threads each)", flush=True)
+results = []
+ctx = torch.multiprocessing.get_context("fork")
+with ctx.Pool(num_procs) as pool:
+    for cfg, total_acc, elapsed in tqdm(pool.imap_unordered(run_config, configs), total=len(configs)):
+        print(f"{cfg} -> max acc {max(total_acc):.2f}% ({elapsed:.0f}s)", flush=True)
+        results.append((cfg, total_acc))
+
+# One row per run: grid values followed by the accuracy of every epoch
+max_epochs = max(len(total_acc) for _, total_acc in results)
+fieldnames = grid_keys + ["max_acc"] + [f"epoch_{epoch}" for epoch in range(1, max_epochs + 1)]
+os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+with open(results_path, "w", newline="") as fileobj:
+    writer = csv.DictWriter(fileobj, fieldnames=fieldnames)
+    writer.writeheader()
+    for cfg, total_acc in sorted(results, key=lambda result: [str(result[0][key]) for key in grid_keys]):
+        row = dict(cfg)
+        row["max_acc"] = max(total_acc)
+        row.update({f"epoch_{epoch}": acc for epoch, acc in enumerate(total_acc, start=1)})
+        writer.writerow(row)
+print(f"Results saved at {results_path}", flush=True)
@@ -12,9 +12,17 @@ import mlconfig
 import numpy as np
 import torchaudio
 import random
+import copy
+import sys
+import time
+import torch.distributed as dist
 
 from torchaudio.datasets import SPEECHCOMMANDS
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+from concurrent.futures import ThreadPoolExecutor
+from surrogate_tools import M5, export_inference_m5, placement_table, noise_stats, update_noise_stats
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 
@@ -30,6 +38,25 @@ poison_rate = 1.0
 transform_sample_rate = 8000
 ## MAKE SURE SEED MATCHES IN PERTURBATION GENERATION CODE!!!
 seed = 8   
+inference_jit = False       # trace + freeze the BatchNorm-folded model used by test() (oneDNN conv+ReLU fusion)
+num_seeds = 1               # > 1: train this many M5 victims (init seeds seed, seed+1, ...) together on the same batches
+# Pre-materialized poisoned shards (written once per perturbation, reused by later runs)
+use_shards = False
+shard_dir = "experiments/shards"
+shard_size = 4096           # clips per shard
+shuffle_buffer_shards = 4   # shards mixed together when shuffling
+# Data-parallel training on CPU processes (torch.distributed, gloo backend)
+world_size = 1              # > 1: train with this many ranks, each on 1/world_size of every (global) batch
+dist_port = 29500           # rendezvous port on localhost (one port per launch)
+dist_benchmark = False      # time benchmark_epochs epochs for every rank count in benchmark_world_sizes, then exit
+benchmark_world_sizes = [1, 2, 4, 8]
+benchmark_epochs = 1
+# Background evaluation: each epoch's (folded) weights are evaluated in a thread pool while the next epoch trains
+async_eval = False
+eval_workers = 1
+eval_threads = 0            # intra-op threads per eval worker, taken from training (0 = a quarter of them, split between workers)
+eval_validation = False     # also report accuracy on the validation split
+eval_benchmark = False      # time benchmark_epochs epochs with synchronous and with background evaluation, then exit
 
 
 
@@ -54,26 +81,49 @@ class SubsetSC(SPEECHCOMMANDS):
             random.seed(seed)
             random.shuffle(self._walker)
 
+    def __getitem__(self, n):
+        # Append the sample id (position in this subset) to every sample
+        return (*super().__getitem__(n), n)
 
+
+####################################
+# DEFINE STACKED M5 MODEL (M5 is in surrogate_tools.py) #
 ####################################
-# DEFINE M5 MODEL #
-####################################    # was 35 output
-class M5(nn.Module):
-    def __init__(self, n_input=1, n_output=35, stride=16, n_channel=32):
+class StackedM5(nn.Module):
+    '''S independent M5 victims executed as one network: the channels of every layer are stacked and the convs
+    are grouped per victim, so BatchNorm, Adam and weight decay stay independent per victim.
+    Output is (batch x S x n_output).'''
+    def __init__(self, models):
         super().__init__()
-        self.conv1 = nn.Conv1d(n_input, n_channel, kernel_size=80, stride=stride)
-        self.bn1 = nn.BatchNorm1d(n_channel)
+        first = models[0]
+        self.num_models = len(models)
+        n_channel = first.conv1.out_channels
+        n_output = first.fc1.out_features
+        S = self.num_models
+        # conv1 sees the same input for every victim, the later layers only their own victim's channels
+        self.conv1 = nn.Conv1d(first.conv1.in_channels, S * n_channel, kernel_size=80, stride=first.conv1.stride[0])
+        self.bn1 = nn.BatchNorm1d(S * n_channel)
         self.pool1 = nn.MaxPool1d(4)
-        self.conv2 = nn.Conv1d(n_channel, n_channel, kernel_size=3)
-        self.bn2 = nn.BatchNorm1d(n_channel)
+        self.conv2 = nn.Conv1d(S * n_channel, S * n_channel, kernel_size=3, groups=S)
+        self.bn2 = nn.BatchNorm1d(S * n_channel)
         self.pool2 = nn.MaxPool1d(4)
-        self.conv3 = nn.Conv1d(n_channel, 2 * n_channel, kernel_size=3)
-        self.bn3 = nn.BatchNorm1d(2 * n_channel)
+        self.conv3 = nn.Conv1d(S * n_channel, S * 2 * n_channel, kernel_size=3, groups=S)
+        self.bn3 = nn.BatchNorm1d(S * 2 * n_channel)
         self.pool3 = nn.MaxPool1d(4)
-        self.conv4 = nn.Conv1d(2 * n_channel, 2 * n_channel, kernel_size=3)
-        self.bn4 = nn.BatchNorm1d(2 * n_channel)
+        self.conv4 = nn.Conv1d(S * 2 * n_channel, S * 2 * n_channel, kernel_size=3, groups=S)
+        self.bn4 = nn.BatchNorm1d(S * 2 * n_channel)
         self.pool4 = nn.MaxPool1d(4)
-        self.fc1 = nn.Linear(2 * n_channel, n_output)
+        self.fc1 = nn.Conv1d(S * 2 * n_channel, S * n_output, kernel_size=1, groups=S)
+
+        # Start from the victims' own (independently seeded) weights
+        with torch.no_grad():
+            for name in ['conv1', 'conv2', 'conv3', 'conv4', 'bn1', 'bn2', 'bn3', 'bn4']:
+                stacked = getattr(self, name)
+                for attr in ['weight', 'bias', 'running_mean', 'running_var']:
+                    if getattr(stacked, attr, None) is not None:
+                        getattr(stacked, attr).copy_(torch.cat([getattr(getattr(m, name), attr) for m in models]))
+            self.fc1.weight.copy_(torch.cat([m.fc1.weight for m in models]).unsqueeze(-1))
+            self.fc1.bias.copy_(torch.cat([m.fc1.bias for m in models]))
 
     def forward(self, x):
         x = self.conv1(x)
@@ -89,8 +139,8 @@ class M5(nn.Module):
         x = F.relu(self.bn4(x))
         x = self.pool4(x)
         x = F.avg_pool1d(x, x.shape[-1])
-        x = x.permute(0, 2, 1)
         x = self.fc1(x)
+        x = x.view(x.shape[0], self.num_models, -1)
         return F.log_softmax(x, dim=2)
 
 
@@ -109,7 +159,7 @@ train_set = SubsetSC("training")
 test_set = SubsetSC("testing")
 
 # Testing the first dataset sample
-waveform, sample_rate, label, speaker_id, utterance_number = train_set[0]
+waveform, sample_rate, label, speaker_id, utterance_number, _ = train_set[0]
 print ("==Test [0]==", flush=True)
 print(f"Testset[0]: {train_set[0]}")
 print(f" Waveform {waveform} \n Sample Rate: {sample_rate} \n Label: {label} \n Utterance Num: {utterance_number}", flush=True)
@@ -117,8 +167,8 @@ print("Shape of waveform: {}".format(waveform.size()))
 print("Sample rate of waveform: {}".format(sample_rate))
 
     
-# Contains names of all sound labels
-labels = sorted(list(set(datapoint[2] for datapoint in train_set)))
+# Contains names of all sound labels (label is the clip's folder name, no need to decode every clip)
+labels = sorted(list(set(os.path.basename(os.path.dirname(path)) for path in train_set._walker)))
 
 # Transforms (currently none applied)
 transform = torchaudio.transforms.Resample(orig_freq=sample_rate, new_freq=sample_rate)
@@ -144,18 +194,19 @@ def pad_sequence(batch):
 
 
 def collate_fn(batch):
-    tensors, targets = [], []
+    tensors, targets, ids = [], [], []
 
-    # Gather in lists, and encode labels as indices
-    for waveform, _, label, *_ in batch:
+    # Gather in lists, and encode labels as indices (sample id is the last item)
+    for waveform, _, label, *_, sample_id in batch:
         tensors += [waveform]
         targets += [label_to_index(label)]
+        ids += [sample_id]
 
     # Group the list of tensors into a batched tensor
     tensors = pad_sequence(tensors)
     targets = torch.stack(targets)
 
-    return tensors, targets
+    return tensors, targets, torch.tensor(ids)
 
 
 if device == "cuda":
@@ -184,7 +235,14 @@ test_loader = torch.utils.data.DataLoader(
 )
 
 ## Set model
-model = M5(n_input=transformed.shape[0], n_output=len(labels)).to(device)
+if num_seeds > 1:
+    victims = []
+    for s in range(num_seeds):
+        torch.manual_seed(seed + s)
+        victims.append(M5(n_input=transformed.shape[0], n_output=len(labels)))
+    model = StackedM5(victims).to(device)
+else:
+    model = M5(n_input=transformed.shape[0], n_output=len(labels)).to(device)
 print(model)
 
 
@@ -195,52 +253,64 @@ print(model)
 ########################################
 #### ADD NOISY SAMPLES ###
 ########################################
-def patch_noise_to_sound(noise, waveform_length=16000, segment_location='center'):
-    # Init mask to zeroes
-    mask = np.zeros(waveform_length, dtype=np.float32) 
-    noise_length = noise.shape[0]
-    if segment_location == 'center' or (waveform_length == noise_length):
-        # Apply noise to the center of the waveform
-        start = (waveform_length - noise_length) // 2
-    elif segment_location == 'random':
-        # Apply noise to a random location in the waveform
-        start = np.random.randint(0, waveform_length - noise_length)
-    else:
-        raise ValueError('Invalid segment location')
-
-    # Find end position (start+length), then check if its in bounds
-    end = start + noise_length
-    mask[start:end] = noise
-    return mask, (start, end)
-    
 class PoisonSC(SubsetSC):
     def __init__(self, subset, poison_rate=1.0, perturb_tensor_filepath=None, patch_location='center'):
         super().__init__(subset=subset)
         # Load Noise from pertubation.pt, set variables
         self.perturb_tensor = torch.load(perturb_tensor_filepath, map_location=device)
-        self.perturb_tensor = self.perturb_tensor.cpu().numpy()
+        self.perturb_tensor = self.perturb_tensor.cpu()
         self.patch_location = patch_location
+        # Where each noise row goes in its waveform: the table speechClass.py stored next to the noise (one row per
+        # noise row), recomputed for standardized 16000 long waveforms only if it is missing
+        placement_filepath = os.path.join(os.path.dirname(perturb_tensor_filepath), 'placement.pt')
+        if os.path.exists(placement_filepath):
+            self.placements = torch.load(placement_filepath).long()
+            if len(self.placements) != len(self.perturb_tensor) or (self.placements[:, 1] - self.placements[:, 0] != self.perturb_tensor.shape[1]).any():
+                raise ValueError(f"{placement_filepath} does not match the noise in {perturb_tensor_filepath} (rows or noise length)")
+        else:
+            print(f"WARNING: {placement_filepath} not found, recomputing {patch_location} placements", flush=True)
+            self.placements = placement_table(np.full(len(self.perturb_tensor), 16000), self.perturb_tensor.shape[1], patch_location, seed)
         self.poison_rate = poison_rate  # Percent of data that is poisoned
         self.poisoned_samples = {} #to store modified examples
+        # Noise generated for a subset comes with an id -> row mapping (perturbation_ids.pt next to the noise)
+        ids_filepath = os.path.join(os.path.dirname(perturb_tensor_filepath), 'perturbation_ids.pt')
+        self.perturb_rows = None
+        if os.path.exists(ids_filepath):
+            perturb_ids = torch.load(ids_filepath).tolist()
+            self.perturb_rows = {sample_id: row for row, sample_id in enumerate(perturb_ids)}
         # Apply Noise to samples so [poison_rate]% of them are noisy
-        # Randomly selected poison targets
-        targets = list(range(len(self)))
+        # Randomly selected poison targets (only samples that have noise, if the mapping exists)
+        targets = list(range(len(self))) if self.perturb_rows is None else perturb_ids
         print(f"Total Targets: {len(self)}", flush=True)
-        self.poison_samples_idx = sorted(np.random.choice(targets, int(len(targets) * poison_rate), replace=False).tolist())
+        num_poison = int(len(self) * poison_rate)
+        if num_poison > len(targets):
+            print(f"WARNING: noise only exists for {len(targets)} samples, poisoning those", flush=True)
+            num_poison = len(targets)
+        # Seeded, so the same seed always poisons the same samples (shard_key relies on it)
+        self.poison_samples_idx = sorted(np.random.RandomState(seed).choice(targets, num_poison, replace=False).tolist())
         print(f"Total poison targets: {len(self.poison_samples_idx)}", flush=True)
+        # Largest noise value, one chunk of rows at a time (no temporary the size of the whole noise store)
+        eps_bound = max((float(chunk.abs().max()) for chunk in self.perturb_tensor.split(1024)), default=1.0)
+        stats = noise_stats(eps_bound)
         
         for idx in self.poison_samples_idx: # Go through every poisoned sample
          
-            noise = self.perturb_tensor[idx % len(self.perturb_tensor)]
-            noise, (start,end) = patch_noise_to_sound(noise, waveform_length=16000, segment_location=self.patch_location)
+            if self.perturb_rows is not None:
+                row = self.perturb_rows[idx]
+            else:
+                row = idx % len(self.perturb_tensor)
+            start, end = self.placements[row].tolist()
             waveform, sample_rate, label, *_ = self[idx]
-            waveform = self._standardize_waveform(waveform)  # if waveforms are incorrect sizes
+            waveform = self._standardize_waveform(waveform, target_length=max(16000, end))  # if waveforms are incorrect sizes
           
-            num_channels = waveform.shape[0]
-            poisoned_waveform = np.zeros_like(waveform.numpy())
-            for channel in range(num_channels):
-                poisoned_waveform[channel] = np.clip(waveform[channel].numpy() + noise, -1, 1) 
-            self.poisoned_samples[idx] = (torch.tensor(poisoned_waveform), sample_rate, label)
+            # Add the noise in place on every channel, then clip
+            poisoned_waveform = waveform.clone()
+            poisoned_waveform[:, start:end] += self.perturb_tensor[row]
+            poisoned_waveform = torch.clamp(poisoned_waveform, -1, 1)
+            update_noise_stats(stats, waveform[None], (poisoned_waveform - waveform)[None])
+            self.poisoned_samples[idx] = (poisoned_waveform, sample_rate, label, idx)
+        for stat in stats:
+            print(stat.summary(), flush=True)
         
     def __getitem__(self,idx):
         if idx in self.poisoned_samples:
@@ -260,11 +330,98 @@ class PoisonSC(SubsetSC):
             waveform = waveform[:, :target_length]
         return waveform
     
-poison_train_set = PoisonSC("training", poison_rate=poison_rate, perturb_tensor_filepath=perturb_tensor_path)
-poison_train_loader = DataLoader(poison_train_set, batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
+
+
+########################################
+#### PRE-MATERIALIZED POISONED SHARDS ###
+########################################
+def shard_key():
+    # Everything the materialized split depends on
+    stat = os.stat(perturb_tensor_path)
+    return repr((os.path.abspath(perturb_tensor_path), stat.st_size, stat.st_mtime_ns, poison_rate, seed, len(train_set), shard_size))
+
+
+def shards_are_current():
+    manifest_path = os.path.join(shard_dir, "manifest.pt")
+    return os.path.exists(manifest_path) and torch.load(manifest_path)["key"] == shard_key()
+
+
+def materialize_shards(dataset):
+    # Write the poisoned, standardized, clipped split as fixed-length float32 shards plus one label array
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_files = []
+    label_array = np.zeros(len(dataset), dtype=np.int64)
+    for shard_start in tqdm(range(0, len(dataset), shard_size), desc="Materializing shards"):
+        shard_end = min(shard_start + shard_size, len(dataset))
+        shard = np.zeros((shard_end - shard_start, 1, 16000), dtype=np.float32)
+        for idx in range(shard_start, shard_end):
+            waveform, _, label, *_ = dataset[idx]
+            waveform = dataset._standardize_waveform(waveform)
+            shard[idx - shard_start] = np.clip(waveform[:1].numpy(), -1, 1)
+            label_array[idx] = labels.index(label)
+        shard_file = "shard_%05d.npy" % (len(shard_files))
+        np.save(os.path.join(shard_dir, shard_file), shard)
+        shard_files.append(shard_file)
+    np.save(os.path.join(shard_dir, "labels.npy"), label_array)
+    # Manifest is written last, so an interrupted run is never mistaken for a complete one
+    torch.save({"key": shard_key(), "shards": shard_files, "shard_size": shard_size, "num_samples": len(dataset)},
+               os.path.join(shard_dir, "manifest.pt"))
+
+
+class ShardLoader:
+    '''Streams (data, target) batches from the shards. Each shard is read in one contiguous load; shards are
+    shuffled, and samples are shuffled within a buffer of shuffle_buffer_shards shards.'''
+    def __init__(self, shard_dir, batch_size, shuffle=True, buffer_shards=4):
+        manifest = torch.load(os.path.join(shard_dir, "manifest.pt"))
+        self.shard_paths = [os.path.join(shard_dir, shard_file) for shard_file in manifest["shards"]]
+        self.shard_size = manifest["shard_size"]
+        self.num_samples = manifest["num_samples"]
+        self.labels = np.load(os.path.join(shard_dir, "labels.npy"))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_shards = buffer_shards
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = np.random.permutation(len(self.shard_paths)) if self.shuffle else np.arange(len(self.shard_paths))
+        carry_data = np.zeros((0, 1, 16000), dtype=np.float32)
+        carry_labels = np.zeros(0, dtype=np.int64)
+        carry_ids = np.zeros(0, dtype=np.int64)
+        for group_start in range(0, len(order), self.buffer_shards):
+            group = order[group_start:group_start + self.buffer_shards]
+            data = np.concatenate([np.load(self.shard_paths[s]) for s in group])
+            ids = np.concatenate([np.arange(s * self.shard_size, min((s + 1) * self.shard_size, self.num_samples)) for s in group])
+            targets = self.labels[ids]
+            if self.shuffle:
+                perm = np.random.permutation(len(data))
+                data, targets, ids = data[perm], targets[perm], ids[perm]
+            # Samples left over from the previous buffer go first, so every batch but the last is full
+            data = np.concatenate([carry_data, data])
+            targets = np.concatenate([carry_labels, targets])
+            ids = np.concatenate([carry_ids, ids])
+            full = len(data) // self.batch_size * self.batch_size
+            for start in range(0, full, self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                yield torch.from_numpy(data[batch]), torch.from_numpy(targets[batch]), torch.from_numpy(ids[batch])
+            carry_data, carry_labels, carry_ids = data[full:], targets[full:], ids[full:]
+        if len(carry_data):
+            yield torch.from_numpy(carry_data), torch.from_numpy(carry_labels), torch.from_numpy(carry_ids)
+
+
+if use_shards:
+    if not shards_are_current():
+        materialize_shards(PoisonSC("training", poison_rate=poison_rate, perturb_tensor_filepath=perturb_tensor_path))
+    poison_train_loader = ShardLoader(shard_dir, batch_size, shuffle=True, buffer_shards=shuffle_buffer_shards)
+    num_train_samples = poison_train_loader.num_samples
+else:
+    poison_train_set = PoisonSC("training", poison_rate=poison_rate, perturb_tensor_filepath=perturb_tensor_path)
+    poison_train_loader = DataLoader(poison_train_set, batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
+    num_train_samples = len(poison_train_set)
 
 # Print dataset information
-print(f'Poisoned Training Dataset: {len(poison_train_set)} samples')
+print(f'Poisoned Training Dataset: {num_train_samples} samples')
 print(f'Test Dataset: {len(test_set)} samples')
 
 
@@ -277,9 +434,14 @@ print(f'Test Dataset: {len(test_set)} samples')
 optimizer = optim.Adam(model.parameters(), lr=0.01, weight_decay=0.0001)
 scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=20, gamma=0.1)  # reduce the learning after 20 epochs by a factor of 10
 
-def train(model, epoch, log_interval):
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def train(model, optimizer, train_loader, epoch, log_interval):
     model.train()
-    for batch_idx, (data, target) in enumerate(poison_train_loader):
+    world = dist.get_world_size() if dist.is_initialized() else 1
+    for batch_idx, (data, target, _) in enumerate(train_loader):
 
         data = data.to(device)
         target = target.to(device)
@@ -289,14 +451,18 @@ def train(model, epoch, log_interval):
         output = model(data)
 
         # negative log-likelihood for a tensor of size (batch x 1 x n_output)
-        loss = F.nll_loss(output.squeeze(), target)
+        if num_seeds > 1:
+            # (batch x S x n_output): sum of the victims' mean losses
+            loss = F.nll_loss(output.permute(0, 2, 1), target[:, None].expand(-1, num_seeds)) * num_seeds
+        else:
+            loss = F.nll_loss(output.squeeze(), target)
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
 
         # print training stats
-        if batch_idx % log_interval == 0:
-            print(f"Train Epoch: {epoch} [{batch_idx * len(data)}/{len(poison_train_loader.dataset)} ({100. * batch_idx / len(poison_train_loader):.0f}%)]\tLoss: {loss.item():.6f}")
+        if batch_idx % log_interval == 0 and is_main_process():
+            print(f"Train Epoch: {epoch} [{batch_idx * len(data) * world}/{num_train_samples} ({100. * batch_idx / len(train_loader):.0f}%)]\tLoss: {loss.item():.6f}")
         
         # update progress bar
         pbar.update(pbar_update)
@@ -313,10 +479,10 @@ def get_likely_index(tensor):
     return tensor.argmax(dim=-1)
 
 
-def test(model, epoch, total_acc):
+def test(model, loader, epoch, total_acc, name="Test"):
     model.eval()
     correct = 0
-    for data, target in test_loader:
+    for data, target, _ in loader:
 
         data = data.to(device)
         target = target.to(device)
@@ -326,31 +492,204 @@ def test(model, epoch, total_acc):
         output = model(data)
 
         pred = get_likely_index(output)
-        correct += number_of_correct(pred, target)
+        if num_seeds > 1:
+            correct += pred.eq(target[:, None]).sum(dim=0).cpu()   # per victim
+        else:
+            correct += number_of_correct(pred, target)
 
         # update progress bar
         pbar.update(pbar_update)
-    acc = (100. * correct / len(test_loader.dataset))
-    print(f"\nTest Epoch: {epoch}\tAccuracy: {correct}/{len(test_loader.dataset)} ({acc:.0f}%)\n")
+    if dist.is_initialized():
+        # Every rank saw its own part of the test set: add up the correct counts
+        correct = torch.as_tensor(correct, dtype=torch.long)
+        dist.all_reduce(correct)
+        if num_seeds == 1:
+            correct = correct.item()
+    # Size of the whole split (a rank's loader only holds a Subset of it)
+    num_samples = len(loader.dataset.dataset) if isinstance(loader.dataset, Subset) else len(loader.dataset)
+    acc = (100. * correct / num_samples)
+    if num_seeds > 1:
+        acc = acc.tolist()
+        if is_main_process():
+            print(f"\n{name} Epoch: {epoch}\tAccuracy over {num_seeds} seeds: {np.mean(acc):.2f}% +- {np.std(acc):.2f}%\n")
+    elif is_main_process():
+        print(f"\n{name} Epoch: {epoch}\tAccuracy: {correct}/{num_samples} ({acc:.0f}%)\n")
     total_acc.append(acc)
+    return acc
 
 
 
-pbar_update = 1 / (len(poison_train_loader) + len(test_loader))
+if eval_validation:
+    val_set = SubsetSC("validation")
+    val_loader = torch.utils.data.DataLoader(
+        val_set,
+        batch_size=batch_size,
+        shuffle=False,
+        drop_last=False,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+    )
+    print(f'Validation Dataset: {len(val_set)} samples')
+
+example_batch = next(iter(test_loader))[0][:8]    # real clips to check the folded model on
+pbar_update = 1 / (len(poison_train_loader) + len(test_loader) + (len(val_loader) if eval_validation else 0))
 losses = []
 
 
+def evaluate_snapshot(snapshot, epoch):
+    # Test (and validation) accuracy of one epoch's frozen weights, and how long evaluating them took
+    eval_start = time.time()
+    with torch.no_grad():
+        acc = test(snapshot, test_loader, epoch, [])
+        val = test(snapshot, val_loader, epoch, [], name="Validation") if eval_validation else None
+    return acc, val, time.time() - eval_start
+
+
+# Background evaluation gets its own intra-op threads instead of competing with training for all of them
+# (torch's OpenMP thread count applies per calling thread)
+default_threads = torch.get_num_threads()
+eval_threads_per_worker = eval_threads or max(1, default_threads // 4 // eval_workers)
+train_threads = max(1, default_threads - eval_threads_per_worker * eval_workers)
+
+
+def run_epochs(run_model, run_optimizer, run_scheduler, epochs, use_async):
+    # Train for epochs, evaluating every epoch's frozen weights synchronously or in the eval pool.
+    # Returns the (test, validation, eval time) results in epoch order and the train/wall time of every epoch
+    global pbar
+    torch.set_num_threads(train_threads if use_async else default_threads)
+    executor = ThreadPoolExecutor(max_workers=eval_workers, initializer=torch.set_num_threads,
+                                  initargs=(eval_threads_per_worker,)) if use_async else None
+    epoch_results, train_times, epoch_times = [], [], []
+    with tqdm(total=epochs) as pbar:
+        for epoch in range(1, epochs + 1):
+            epoch_start = time.time()
+            # Train
+            print("="*20 + "Training Epoch %d" % (epoch) + "="*20, flush=True)
+            train(run_model, run_optimizer, poison_train_loader, epoch, log_interval)
+            train_times.append(time.time() - epoch_start)
+            # Eval on a frozen copy of this epoch's weights (in the background if use_async)
+            snapshot = export_inference_m5(run_model, example_batch.to(device), use_jit=inference_jit)
+            if executor is not None:
+                epoch_results.append(executor.submit(evaluate_snapshot, snapshot, epoch))
+            else:
+                epoch_results.append(evaluate_snapshot(snapshot, epoch))
+            run_scheduler.step()
+            epoch_times.append(time.time() - epoch_start)
+            print(f"Epoch {epoch} took {epoch_times[-1]:.1f}s (training {train_times[-1]:.1f}s)", flush=True)
+        if executor is not None:
+            # Gather in epoch order
+            epoch_results = [future.result() for future in epoch_results]
+            executor.shutdown()
+    torch.set_num_threads(default_threads)
+    return epoch_results, train_times, epoch_times
+
+
+
+
+##########################
+## DATA-PARALLEL TRAINING ##
+##########################
+def run_rank(rank, world, epochs, result_queue):
+    # One rank: same initial weights as every other rank, 1/world of every batch, gradients averaged by DDP
+    global pbar, pbar_update
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world))
+    dist.init_process_group("gloo", rank=rank, world_size=world)
+    rank_model = DistributedDataParallel(copy.deepcopy(model))
+    rank_optimizer = optim.Adam(rank_model.parameters(), lr=0.01, weight_decay=0.0001)
+    rank_scheduler = optim.lr_scheduler.StepLR(rank_optimizer, step_size=20, gamma=0.1)
+    sampler = DistributedSampler(poison_train_set, num_replicas=world, rank=rank, shuffle=True, seed=seed)
+    rank_train_loader = DataLoader(poison_train_set, batch_size=max(1, batch_size // world), sampler=sampler, collate_fn=collate_fn)
+    rank_test_loader = DataLoader(Subset(test_set, range(rank, len(test_set), world)), batch_size=batch_size,
+                                  shuffle=False, drop_last=False, collate_fn=collate_fn)
+    pbar_update = 1 / (len(rank_train_loader) + len(rank_test_loader))
+
+    rank_acc = []
+    start_time = time.time()
+    with tqdm(total=epochs, disable=rank != 0) as pbar:
+        for epoch in range(1, epochs + 1):
+            sampler.set_epoch(epoch)
+            if rank == 0:
+                print("="*20 + "Training Epoch %d (%d ranks)" % (epoch, world) + "="*20, flush=True)
+            train(rank_model, rank_optimizer, rank_train_loader, epoch, log_interval)
+            # BatchNorm statistics are per rank: evaluate every rank with rank 0's
+            for buffer in rank_model.module.buffers():
+                dist.broadcast(buffer, 0)
+            test(export_inference_m5(rank_model.module, example_batch, use_jit=inference_jit),
+                 rank_test_loader, epoch, rank_acc)
+            rank_scheduler.step()
+    elapsed = time.time() - start_time
+    if rank == 0:
+        result_queue.put((rank_acc, elapsed))
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def launch_ranks(world, epochs, launch_idx=0):
+    # Fork world ranks (they inherit the datasets and the initial model) and return rank 0's accuracies and time
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(dist_port + launch_idx)
+    result_queue = torch.multiprocessing.get_context("fork").SimpleQueue()
+    context = torch.multiprocessing.start_processes(run_rank, args=(world, epochs, result_queue), nprocs=world,
+                                                    join=False, start_method="fork")
+    while not context.join():
+        pass
+    return result_queue.get()
+
+
+if world_size > 1 or dist_benchmark:
+    if use_shards or device.type != "cpu":
+        raise ValueError("Data-parallel training runs CPU ranks over PoisonSC (use_shards = False)")
+
+
+
+
 transform = transform.to(device)
 total_acc = []
-with tqdm(total=n_epoch) as pbar:
-    for epoch in range(1, n_epoch + 1):
-        # Train
-        print("="*20 + "Training Epoch %d" % (epoch) + "="*20, flush=True)
-        train(model, epoch, log_interval)
-        # Eval
-        test(model, epoch, total_acc)
-        scheduler.step()
-print (f"Accuracy Plot coords: {total_acc}")
+val_acc = []
+if dist_benchmark:
+    # Scaling benchmark: same global batch size and epochs for every rank count
+    times = {}
+    for launch_idx, world in enumerate(benchmark_world_sizes):
+        _, times[world] = launch_ranks(world, benchmark_epochs, launch_idx)
+        print(f"{world} rank(s): {times[world]:.1f}s for {benchmark_epochs} epoch(s), "
+              f"{benchmark_epochs * num_train_samples / times[world]:.0f} samples/s, "
+              f"speedup {times[benchmark_world_sizes[0]] / times[world]:.2f}x", flush=True)
+    sys.exit(0)
+elif world_size > 1:
+    total_acc, elapsed = launch_ranks(world_size, n_epoch)
+    print(f"Trained on {world_size} ranks in {elapsed:.1f}s", flush=True)
+elif eval_benchmark:
+    # Same epochs from the same initial weights, once with synchronous and once with background evaluation
+    for use_async in [False, True]:
+        bench_model = copy.deepcopy(model)
+        bench_optimizer = optim.Adam(bench_model.parameters(), lr=0.01, weight_decay=0.0001)
+        bench_scheduler = optim.lr_scheduler.StepLR(bench_optimizer, step_size=20, gamma=0.1)
+        bench_start = time.time()
+        epoch_results, train_times, epoch_times = run_epochs(bench_model, bench_optimizer, bench_scheduler, benchmark_epochs, use_async)
+        eval_times = [eval_time for *_, eval_time in epoch_results]
+        print(f"{'Background' if use_async else 'Synchronous'} evaluation ({train_threads if use_async else default_threads} training threads): "
+              f"{np.mean(epoch_times):.1f}s per epoch, training {np.mean(train_times):.1f}s, evaluation {np.mean(eval_times):.1f}s, "
+              f"{time.time() - bench_start:.1f}s total", flush=True)
+    sys.exit(0)
+else:
+    epoch_results, train_times, epoch_times = run_epochs(model, optimizer, scheduler, n_epoch, async_eval)
+    eval_times = [eval_time for *_, eval_time in epoch_results]
+    print(f"Per epoch: {np.mean(epoch_times):.1f}s wall, {np.mean(train_times):.1f}s training, {np.mean(eval_times):.1f}s evaluation"
+          f" ({'background' if async_eval else 'synchronous'})", flush=True)
+    for acc, val, _ in epoch_results:
+        total_acc.append(acc)
+        if val is not None:
+            val_acc.append(val)
+if num_seeds > 1:
+    # total_acc is (epochs x seeds)
+    acc_curves = np.array(total_acc)
+    print (f"Accuracy Plot coords (mean): {acc_curves.mean(axis=1).tolist()}")
+    print (f"Accuracy Plot coords (std): {acc_curves.std(axis=1).tolist()}")
+else:
+    print (f"Accuracy Plot coords: {total_acc}")
+if val_acc:
+    print (f"Validation Accuracy Plot coords: {val_acc}")
 
 # plot the training loss
 #plt.plot(losses)